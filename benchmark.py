@@ -0,0 +1,432 @@
+# benchmarks for the download and parse scripts
+# usage: python benchmark.py html [PAGES_DIR] [--repeat 20]
+#   PAGES_DIR holds saved SIN-online channel and questionnaire pages (*.html), default benchmark_pages
+# usage: python benchmark.py spss [SPSS_DIR] [--repeat 5]
+#   checks parse_results.parse_spss_syntax against the three-pass parser it replaced and compares throughput,
+#   missing answers (-1) are left out of the comparison
+# usage: python benchmark.py import [SPSS_DIR] [--files-per-transaction 100]
+#   imports the parsed files into new sqlite databases, one transaction per file against batched
+#   transactions with a savepoint per file, with sqlite defaults and with wal + synchronous normal
+# usage: python benchmark.py suite [--evaluations 200] [--respondents 200] [--latency 0.05]
+#   generates synthetic fixtures (fixtures.py), downloads them from sin_stub_server.py in a background thread,
+#   then parses and imports them, throughput of download, parse and import are reported separately
+import os # os interactions, from std library
+import re # regular expressions, from std library
+import io # to open files with explicit unicode encoding, from std library
+import time # for timing, from std library
+import argparse # command line arguments, from std library
+import copy # parsed files are copied for every import run, from std library
+import shutil # to remove temporary databases, from std library
+import tempfile # temporary databases, from std library
+import threading # stand-in server thread, from std library
+import multiprocessing # parse processes, from std library
+from multiprocessing.dummy import Pool as ThreadPool # pool of worker threads, from std library
+
+import parse_results
+import sin_pages
+
+# globals
+PAGES_DIR = 'benchmark_pages' # saved channel and questionnaire pages
+# SPSS exports the parity check always includes, next to the files in SPSS_DIR
+SPSS_LABELS = [u'END DATA.', u'', u'VARIABLE LABELS', u'',
+    u'\tVAR1\tDe docent Jansen heeft de stof duidelijk uitgelegd',
+    u'\tVAR2\tThe tutorial sessions were well organised',
+    u'\tVAR3\tI learned a lot in this course',
+    u'', u'VALUE LABELS',
+    u'/VAR1\t"1"\t"oneens"', u'\t"2"\t"eens"',
+    u'/VAR2\t"1"\t"disagree"', u'\t"2"\t"agree"',
+    u'/VAR3\t"1"\t"disagree"', u'\t"2"\t"agree"']
+SPSS_CASES = {
+    # rows shorter than the header, the last header column has no result in any row
+    'short rows' : [u'DATA LIST LIST(",") VAR1 VAR2 VAR3.', u'BEGIN DATA.', u'1,1', u'2,2,1'] + SPSS_LABELS,
+    'short rows, one column' : [u'DATA LIST LIST(",") VAR1 VAR2 VAR3.', u'BEGIN DATA.', u'1,1', u'2,2', u'3'] + SPSS_LABELS
+    }
+
+# functions
+def extract_channel_id_soup(channel_page):
+    # reference: full BeautifulSoup tree, as download_results did before the targeted extraction
+    from bs4 import BeautifulSoup
+    soup_channel_page = BeautifulSoup(channel_page, 'lxml')
+    channel_title_tag = str(soup_channel_page.find('h2', class_ = 'channel_title'))
+    channel_title = re.findall('#([0-9]+)', channel_title_tag)
+    if channel_title:
+        return channel_title[0]
+    return None
+
+def extract_evaluation_ids_soup(evaluation_page):
+    # reference: full BeautifulSoup tree, as download_results did before the targeted extraction
+    from bs4 import BeautifulSoup
+    soup_evaluation_page = BeautifulSoup(evaluation_page, 'lxml')
+    evaluation_id_tags = soup_evaluation_page.find_all('a', string = re.compile('course evaluation|onderwijsevaluatie', re.IGNORECASE))
+    evaluation_id_collection = {}
+    for tag in evaluation_id_tags:
+        evaluation_id = re.findall('objid=([0-9]+)', str(tag))
+        if evaluation_id:
+            evaluation_id_collection[evaluation_id[0]] = tag.text.lower()
+    return evaluation_id_collection
+
+def parse_spss_syntax_legacy(lines):
+    # reference: three-pass SPSS parser, as parse_spss_file did before the single-pass parser
+    parsed = {}
+    NA_VALUE = parse_results.NA_VALUE
+    if len(lines) == 0:
+        return None
+    question_ids = [col for col in lines[0].split(')')[-1][:-1].strip().split(' ')]
+    line_num = 2
+    for line in lines[line_num:]:
+        line_num += 1
+        if line == 'END DATA.':
+            break
+        row = line.split(',')
+        respondent_id = row[0]
+        question_results = row[1:]
+        for question_id, question_result in zip(question_ids, question_results):
+            question_result = int(question_result)
+            if question_id not in parsed:
+                parsed[question_id] = {
+                'text' : NA_VALUE,
+                'tag' : NA_VALUE,
+                'language' : NA_VALUE,
+                'person' : NA_VALUE,
+                'session_form' : NA_VALUE,
+                'question_ordernr' : NA_VALUE,
+                'type' : NA_VALUE,
+                'db_question_id' : NA_VALUE,
+                'answer_options' : {},
+                'results' : {}
+                }
+            parsed[question_id]['results'][respondent_id] = question_result
+    if len(parsed) == 0:
+        return None
+    line_num += 3
+    question_ordernr = 1
+    for line in lines[line_num:]:
+        if line == '':
+            break
+        line_num += 1
+        line_items = line[1:].split('\t')
+        question_id, text = [item for item in line_items if len(item)>0]
+        text = ' '.join(text.split())
+        if question_id not in parsed:
+            continue
+        parse_name = re.compile(r'''
+            mentor\s(\S\S.+?)(?:\bheeft\b|\bhas\b|$)|
+            docent\s(\S\S.+?)(?:\bheeft\b|\bmaakt\b|\bgeeft\b|$)|
+            lecturer\s(\S\S.+?)(?:\bhas\b|\bmakes\b|\bgives\b|\bprovides\b|\bis\b|$)''',
+            re.IGNORECASE | re.VERBOSE)
+        name = parse_name.findall(text)
+        if name:
+            name = ''.join(name[0]).strip()
+            if name.startswith('heb'):
+                name = None
+            else:
+                text = text.replace(name, '%p')
+                parsed[question_id]['person'] = name
+        text = re.sub('[^A-Za-z %]', '', text)
+        parse_session_form = re.compile(r'''
+            (sommen|vaardigheden|(?<![+])practic|mentor)|
+            (skills|(?<![+])tutorial|exercise|mentor)''',
+            re.IGNORECASE | re.VERBOSE)
+        session_form = parse_session_form.findall(text)
+        if session_form:
+            session_form = ''.join(session_form[0]).strip().lower()
+            if session_form == 'sommen' or session_form == 'exercise':
+                session_form = 'exercise lecture'
+            elif session_form == 'vaardigheden' or session_form == 'skills':
+                session_form = 'skills tutorial'
+            elif session_form == 'mentor':
+                session_form = 'guidance'
+            else:
+                session_form = 'tutorial'
+            parsed[question_id]['session_form'] = session_form
+        parsed[question_id]['text'] = text
+        parsed[question_id]['question_ordernr'] = question_ordernr
+        parsed[question_id]['type'] = 'mc'
+        question_ordernr += 1
+    line_num += 2
+    previous_question_id = None
+    for line in lines[line_num:]:
+        line_items = [item for item in line.split('\t') if len(item)>0]
+        if 'VAR' in line_items[0]:
+            question_id, answer_option_id, answer_option_text = line_items
+            if question_id.startswith('/'):
+                question_id = question_id[1:]
+            previous_question_id = question_id
+        else:
+            question_id = previous_question_id
+            answer_option_id, answer_option_text = line_items
+        if question_id not in parsed:
+            continue
+        answer_option_id = int(answer_option_id[1:-1])
+        parsed[question_id]['answer_options'][answer_option_id] = answer_option_text[1:-1]
+    return parsed
+
+def expand_parsed(parsed):
+    # nested form of the columnar parse result, results as {respondent id: answer} without missing answers
+    if parsed is None:
+        return None
+    expanded = {}
+    for question_id, content in parsed['questions'].items():
+        expanded[question_id] = dict(content)
+        expanded[question_id]['results'] = dict((respondent_id, result)
+            for respondent_id, result in zip(parsed['respondents'], content['results'])
+            if result != parse_results.MISSING)
+    return expanded
+
+def drop_missing(parsed):
+    # legacy parse result without missing answers, to compare with expand_parsed
+    if parsed is None:
+        return None
+    for content in parsed.values():
+        content['results'] = dict((respondent_id, result)
+            for respondent_id, result in content['results'].items() if result != parse_results.MISSING)
+    return parsed
+
+def time_calls(function, items, repeat):
+    # seconds for calling function on all items, repeat times, best of three
+    best = None
+    for run in range(3):
+        start_time = time.time()
+        for count in range(repeat):
+            for item in items:
+                function(item)
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, count, unit):
+    print '%-30s %10.4f s %12.1f %s/s' % (name, seconds, count / seconds if seconds else 0.0, unit)
+
+def benchmark_html(pages_dir, repeat):
+    # compare the sin_pages extraction with full BeautifulSoup trees on saved pages
+    pages = []
+    for page_file in sorted(os.listdir(pages_dir)):
+        if page_file.endswith('.html'):
+            pages.append(io.open(os.path.join(pages_dir, page_file), encoding = 'utf-8').read())
+    if not pages:
+        print 'No saved pages (*.html) found in', pages_dir
+        return
+    mismatches = 0
+    for page in pages:
+        if extract_channel_id_soup(page) != sin_pages.extract_channel_id(page):
+            mismatches += 1
+        if extract_evaluation_ids_soup(page) != sin_pages.extract_evaluation_ids(page):
+            mismatches += 1
+    print 'Pages:', len(pages), 'mismatches:', mismatches
+
+    def soup(page):
+        extract_channel_id_soup(page)
+        extract_evaluation_ids_soup(page)
+
+    def targeted(page):
+        sin_pages.extract_channel_id(page)
+        sin_pages.extract_evaluation_ids(page)
+
+    report('BeautifulSoup + lxml', time_calls(soup, pages, repeat), len(pages) * repeat, 'pages')
+    report('HTMLParser extraction', time_calls(targeted, pages, repeat), len(pages) * repeat, 'pages')
+
+def benchmark_spss(spss_dir, repeat):
+    # parity check and throughput of the single-pass SPSS parser against the three-pass parser
+    paths = [os.path.join(spss_dir, spss_file) for spss_file in sorted(os.listdir(spss_dir))
+             if spss_file.endswith('.txt')]
+    if not paths:
+        print 'No SPSS files (*.txt) found in', spss_dir
+        return
+
+    def read_lines(path):
+        with io.open(path, encoding = 'utf-8') as spss_file:
+            return [line for file_line in spss_file for line in file_line.splitlines()]
+
+    def legacy(path):
+        return parse_spss_syntax_legacy(read_lines(path))
+
+    def single_pass(path):
+        with io.open(path, encoding = 'utf-8') as spss_file:
+            return parse_results.parse_spss_syntax(line for file_line in spss_file for line in file_line.splitlines())
+
+    def outcome(function, lines):
+        # parsed result, or the type of error for files both parsers should reject
+        try:
+            return function(lines)
+        except Exception as error:
+            return type(error).__name__
+
+    cases = [(path, read_lines(path)) for path in paths] + sorted(SPSS_CASES.items())
+    mismatches = [name for name, lines in cases
+                  if outcome(lambda lines: drop_missing(parse_spss_syntax_legacy(lines)), lines) !=
+                     outcome(lambda lines: expand_parsed(parse_results.parse_spss_syntax(iter(lines))), lines)]
+    print 'Files:', len(paths), '+', len(SPSS_CASES), 'built-in cases, mismatches:', len(mismatches)
+    for name in mismatches:
+        print '  mismatch:', name
+    paths = [path for path in paths if not isinstance(outcome(legacy, path), str)] # time parseable files only
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    megabytes = total_bytes * repeat / 1e6
+    report('three-pass parser', time_calls(legacy, paths, repeat), megabytes, 'MB')
+    report('single-pass parser', time_calls(single_pass, paths, repeat), megabytes, 'MB')
+
+def import_run(parsed_files, files_per_transaction, pragmas):
+    # seconds to import parsed_files into a new sqlite database
+    db_dir = tempfile.mkdtemp()
+    try:
+        db = parse_results.create_db_engine('sqlite:///' + os.path.join(db_dir, 'benchmark.db'), **pragmas)
+        tables = parse_results.define_db()
+        tables['table_evaluation'].metadata.create_all(db)
+        connection = db.connect()
+        question_index = parse_results.load_question_index(connection, tables)
+        ledger = parse_results.load_import_ledger(connection, tables)
+        parsed_files = copy.deepcopy(parsed_files) # insert_data adds keys to parsed
+        start_time = time.time()
+        transaction = None
+        for file_counter, (file, parsed, hashes) in enumerate(parsed_files, 1):
+            if files_per_transaction > 1 and transaction is None:
+                transaction = connection.begin()
+            parse_results.import_file(file, parsed, [], connection, tables, question_index, ledger, hashes)
+            if transaction is not None and (file_counter % files_per_transaction == 0 or file_counter == len(parsed_files)):
+                transaction.commit()
+                parse_results.commit_question_index(question_index)
+                transaction = None
+        elapsed = time.time() - start_time
+        connection.close()
+        db.dispose()
+        return elapsed
+    finally:
+        shutil.rmtree(db_dir)
+
+def benchmark_import(spss_dir, files_per_transaction):
+    # import throughput per transaction mode and sqlite settings, files are parsed once up front
+    parse_results.SPSS_DIR = spss_dir
+    files = sorted(file for file in os.listdir(spss_dir) if file.endswith('.txt'))
+    if not files:
+        print 'No SPSS files (*.txt) found in', spss_dir
+        return
+    language_cache = parse_results.load_language_cache(None)
+    parsed_files = [(file, parse_results.parse_spss_file(file, language_cache), parse_results.import_hashes(file))
+                    for file in files]
+    print 'Files:', len(files)
+    tuned = {'journal_mode' : 'wal', 'synchronous' : 'normal', 'cache_size' : -64000}
+    for name, transaction_files, pragmas in [
+            ('per file, sqlite defaults', 1, {}),
+            ('per file, wal + normal', 1, tuned),
+            ('%s files, sqlite defaults' % files_per_transaction, files_per_transaction, {}),
+            ('%s files, wal + normal' % files_per_transaction, files_per_transaction, tuned)]:
+        report(name, import_run(parsed_files, transaction_files, pragmas), len(files), 'files')
+
+def artifact_bytes():
+    # bytes of the SPSS, definition and excel files in the current dir
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory in (parse_results.SPSS_DIR, parse_results.DEFINITION_DIR, parse_results.EXCEL_DIR)
+               for name in os.listdir(directory))
+
+def benchmark_suite(args):
+    # synthetic fixtures downloaded from the stand-in server, parsed and imported in a temporary dir
+    # download_results, fixtures and sin_stub_server are only imported here, the other benchmarks
+    # run with parse_results alone
+    import download_results
+    import fixtures
+    import sin_stub_server
+    work_dir = tempfile.mkdtemp()
+    current_dir = os.getcwd()
+    server = None
+    pool = None
+    try:
+        courses = fixtures.generate_fixtures(os.path.join(work_dir, 'fixtures'), args.evaluations, args.respondents,
+            args.questions, args.open_questions, args.evaluations_per_course, args.seed)
+        evaluations = sum(len(course['evaluations']) for course in courses.values())
+        os.chdir(work_dir)
+        for directory in (parse_results.SPSS_DIR, parse_results.DEFINITION_DIR, parse_results.EXCEL_DIR,
+                          parse_results.LOGGING_DIR):
+            os.makedirs(directory)
+        # parse processes are started before the server and download threads
+        language_cache = parse_results.load_language_cache(None)
+        if args.parse_workers > 1:
+            pool = multiprocessing.Pool(args.parse_workers, parse_results.init_parse_worker, (language_cache, False))
+        server = sin_stub_server.SINStubServer(('localhost', 0), os.path.join(work_dir, 'fixtures'),
+            latency = args.latency)
+        server_thread = threading.Thread(target = server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        # download
+        download_results.SIN_HTTP_URL = download_results.SIN_HTTPS_URL = 'http://localhost:%s' % server.server_address[1]
+        workers = max(args.workers or download_results.WORKERS, 1)
+        start_time = time.time()
+        sess = download_results.SINSession({'login_user' : 'benchmark', 'login_passwd' : ''}, workers)
+        sess.login()
+        downloader = {
+            'sess' : sess,
+            'evaluation_pool' : ThreadPool(workers),
+            'manifest' : download_results.load_manifest(download_results.MANIFEST_FILE),
+            'discovery_cache' : download_results.load_discovery_cache(download_results.DISCOVERY_CACHE_FILE)
+            }
+        course_pool = ThreadPool(workers)
+        course_pool.map(lambda course: download_results.download_course(course, downloader), sorted(courses))
+        download_seconds = time.time() - start_time
+        course_pool.close()
+        downloader['evaluation_pool'].close()
+        megabytes = artifact_bytes() / 1e6
+
+        # parse
+        files = sorted(os.listdir(parse_results.SPSS_DIR))
+        start_time = time.time()
+        if pool:
+            parsed_files = list(pool.imap(parse_results.parse_file_worker, ((file, None) for file in files)))
+        else:
+            parsed_files = [parse_results.parse_file_serial((file, None), language_cache) for file in files]
+        parse_seconds = time.time() - start_time
+        parsed_files = [(file, parsed, parse_results.import_hashes(file)) for file, parsed, _, _, _ in parsed_files]
+
+        # import
+        import_seconds = import_run(parsed_files, max(args.files_per_transaction, 1), {})
+
+        print 'Evaluations:', evaluations, 'downloaded:', len(files), 'MB:', round(megabytes, 1)
+        print 'Download workers:', workers, 'latency:', args.latency, 's, parse workers:', max(args.parse_workers, 1)
+        for name, seconds in [('download', download_seconds), ('parse', parse_seconds), ('import', import_seconds)]:
+            report(name, seconds, len(files), 'evals')
+            report('', seconds, megabytes, 'MB')
+    finally:
+        os.chdir(current_dir)
+        if pool:
+            pool.close()
+            pool.join()
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the download and parse scripts')
+    subparsers = parser.add_subparsers(dest = 'command')
+    html_parser = subparsers.add_parser('html', help = 'html extraction on saved SIN-online pages')
+    html_parser.add_argument('pages_dir', nargs = '?', default = PAGES_DIR)
+    html_parser.add_argument('--repeat', type = int, default = 20)
+    spss_parser = subparsers.add_parser('spss', help = 'SPSS parser parity and throughput')
+    spss_parser.add_argument('spss_dir', nargs = '?', default = parse_results.SPSS_DIR)
+    spss_parser.add_argument('--repeat', type = int, default = 5)
+    import_parser = subparsers.add_parser('import', help = 'db import per transaction mode and sqlite settings')
+    import_parser.add_argument('spss_dir', nargs = '?', default = parse_results.SPSS_DIR)
+    import_parser.add_argument('--files-per-transaction', type = int, default = 100)
+    suite_parser = subparsers.add_parser('suite', help = 'download, parse and import throughput on synthetic fixtures')
+    suite_parser.add_argument('--evaluations', type = int, default = 200)
+    suite_parser.add_argument('--respondents', type = int, default = 200)
+    suite_parser.add_argument('--questions', type = int, default = 20)
+    suite_parser.add_argument('--open-questions', type = int, default = 2)
+    suite_parser.add_argument('--evaluations-per-course', type = int, default = 1)
+    suite_parser.add_argument('--seed', type = int, default = 1)
+    suite_parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds per response of the server')
+    suite_parser.add_argument('-w', '--workers', type = int,
+        help = 'concurrent downloads (default: download_results.WORKERS)')
+    suite_parser.add_argument('-p', '--parse-workers', type = int, default = parse_results.WORKERS)
+    suite_parser.add_argument('--files-per-transaction', type = int, default = 1)
+    args = parser.parse_args()
+    if args.command == 'html':
+        benchmark_html(args.pages_dir, args.repeat)
+    elif args.command == 'spss':
+        benchmark_spss(args.spss_dir, args.repeat)
+    elif args.command == 'import':
+        benchmark_import(args.spss_dir, max(args.files_per_transaction, 1))
+    elif args.command == 'suite':
+        benchmark_suite(args)
+
+if __name__ == '__main__':
+    main()
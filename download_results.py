@@ -2,135 +2,428 @@
 # format for inputfile: VAKACODE-YEAR (example: FEM11090-15)
 import os # os interactions, from std library
 import re # regular expressions, from std library
+import json # to import / export json, from std library
+import hashlib # content hashes for the download manifest, from std library
+import tempfile # temporary files for atomic writes, from std library
 import logging # logging, from std library
-import sys # system interactions, from std library
-from datetime import datetime # for dates + times, from std. library
+import argparse # command line arguments, from std library
+import threading # locks for concurrent downloads, from std library
+from multiprocessing.dummy import Pool as ThreadPool # pool of worker threads, from std library
+from datetime import datetime, timedelta # for dates + times, from std. library
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import run_report # per-stage timings and profiling
+import sin_pages # channel id and evaluation links from SIN-online pages
 
 # globals
 SPSS_DIR = 'SIN_SPSS'
 EXCEL_DIR = 'SIN_excel'
 DEFINITION_DIR = 'SIN_definitions'
 LOGGING_DIR = 'logs'
+WORKERS = 4 # default number of concurrent downloads
+MANIFEST_FILE = 'download_manifest.txt' # record of downloaded files per evaluation id
+DISCOVERY_CACHE_FILE = 'discovery_cache.txt' # channel id and evaluation ids per course
+CHUNK_SIZE = 64 * 1024 # bytes per chunk when streaming downloads to disk
+TIMEOUT = (10, 120) # seconds to connect, seconds between received bytes
+RETRIES = 5 # retries per request on connection errors and RETRY_STATUS responses
+BACKOFF_FACTOR = 1 # wait 0, 2, 4, 8, ... seconds between retries
+RETRY_STATUS = (500, 502, 503, 504)
+SIN_HTTP_URL = 'http://ese.sin-online.nl'
+SIN_HTTPS_URL = 'https://ese.sin-online.nl'
+UMASK = os.umask(0) # os.umask only returns the umask when it sets a new one, so it is set back right away
+os.umask(UMASK)
+FILE_MODE = 0666 & ~UMASK # mode of saved files, as for files created with open()
+LOGIN_PAGE = re.compile(r'/channel/index\.html') # SIN-online redirects here when the login is dropped
+LOGIN_FORM = re.compile(r'name\s*=\s*["\']?login_passwd\b') # password field of the login page
+LOGIN_ATTEMPTS = 5 # new logins per request before the request fails
+
+PRINT_LOCK = threading.Lock()
 
 # set up logging
 logging.getLogger("urllib3").setLevel(logging.WARNING) # disable verbose logging by urllib
 logging.getLogger("requests").setLevel(logging.WARNING) # disable verbose logging by requests
-logging.basicConfig(filename = os.path.join(os.getcwd(), 
-                                LOGGING_DIR, 'download_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'), 
-                                level = logging.INFO,
-                                format = '%(asctime)s: %(message)s', datefmt = '%Y_%m_%d_%H:%M:%S')
 
 # functions
-def sin_login():
+class SINSession(requests.Session):
+    # session for SIN-online with keep-alive connection pools, per-request timeouts,
+    # exponential backoff on 5xx and connection errors and a new login when SIN-online drops the login
+    def __init__(self, payload, workers = WORKERS, timeout = TIMEOUT, retries = RETRIES):
+        super(SINSession, self).__init__()
+        retry = Retry(total = retries, connect = retries, read = retries, status = retries,
+            backoff_factor = BACKOFF_FACTOR, status_forcelist = RETRY_STATUS)
+        # course workers and evaluation workers can each hold a connection, pools are sized for both
+        adapter = HTTPAdapter(pool_connections = 2, pool_maxsize = 2 * workers, max_retries = retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.payload = payload
+        self.timeout = timeout
+        self.login_count = 0
+        self.login_lock = threading.Lock()
+
+    def login(self):
+        # log in, raises requests.RequestException when the login fails or SIN-online shows the login form again
+        response = super(SINSession, self).request('POST', SIN_HTTPS_URL + '/channel/index.html?SSOIMPORT=NONE',
+            data = self.payload, timeout = self.timeout)
+        response.raise_for_status()
+        if logged_out(response) or LOGIN_FORM.search(response.text):
+            raise requests.RequestException('login to SIN-online failed', response = response)
+        self.login_count += 1
+
+    def request(self, method, url, **kwargs):
+        # request url, log in again and repeat the request when SIN-online dropped the login,
+        # raises requests.RequestException when still logged out after LOGIN_ATTEMPTS new logins
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(LOGIN_ATTEMPTS + 1):
+            login_count = self.login_count
+            response = super(SINSession, self).request(method, url, **kwargs)
+            if not logged_out(response):
+                return response
+            response.close()
+            if attempt == LOGIN_ATTEMPTS:
+                break
+            with self.login_lock:
+                if self.login_count == login_count: # skip if another worker logged in again meanwhile
+                    logging.info('Login dropped by SIN-online, logging in again')
+                    self.login()
+        raise requests.RequestException('still logged out after %d new logins: %s' % (LOGIN_ATTEMPTS, url),
+            response = response)
+
+def logged_out(response):
+    # SIN-online sends requests without a valid login to the login page
+    if response.status_code in (401, 403):
+        return True
+    return bool(response.history) and LOGIN_PAGE.search(response.url) is not None
+
+def sin_login(workers = WORKERS):
     # login, return session
-    sess = requests.session()
     pwd = # inclide pwd from local file
     payload = {'login_user' : 'evaluaties@few', 'login_passwd' : pwd}
-    sess.post('https://ese.sin-online.nl/channel/index.html?SSOIMPORT=NONE', data = payload)
+    sess = SINSession(payload, workers)
+    sess.login()
     print 'Logged into SIN-online'
     logging.info('Logged into SIN-online')
 
     return sess
 
-def download_results(filename, sess):
+def load_records(path):
+    # load records file, one json record per line, a half-written last line of an interrupted run is ignored
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def append_record(path, lock, record):
+    # append one json record, flushed right away so an interrupted run can resume
+    with lock:
+        with open(path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+def load_manifest(path, verify = False):
+    # load download manifest, later records replace earlier ones
+    manifest = {'path' : path, 'verify' : verify, 'records' : {}, 'lock' : threading.Lock()}
+    for record in load_records(path):
+        manifest['records'][(record['evaluation_id'], record['artifact'])] = record
+    return manifest
+
+def file_sha1(path):
+    # content hash of file, read in chunks
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def in_manifest(manifest, evaluation_id, artifact, path):
+    # check if artifact was fetched before and the file on disk still matches the manifest
+    record = manifest['records'].get((evaluation_id, artifact))
+    if not record or record['path'] != path or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != record['size']:
+        return False
+    if manifest['verify'] and file_sha1(path) != record['sha1']:
+        return False
+    return True
+
+def add_to_manifest(manifest, evaluation_id, artifact, path, size, sha1):
+    # add record for fetched artifact
+    record = {
+        'evaluation_id' : evaluation_id,
+        'artifact' : artifact,
+        'path' : path,
+        'size' : size,
+        'sha1' : sha1,
+        'fetched' : datetime.now().strftime('%Y_%m_%d_%H:%M:%S')
+        }
+    manifest['records'][(evaluation_id, artifact)] = record
+    append_record(manifest['path'], manifest['lock'], record)
+
+def replace_file(source, target):
+    # rename source to target, os.rename does not overwrite an existing target on windows
+    try:
+        os.rename(source, target)
+    except OSError:
+        os.remove(target)
+        os.rename(source, target)
+
+def fetch_artifact(sess, manifest, url, path, evaluation_id, artifact, binary = False, contents = None):
+    # request url and stream response to path, skip request if manifest has an unchanged copy
+    # the response is written in chunks to a temporary file that is renamed to path when complete,
+    # so an interrupted download never leaves a partial file behind
+    # if contents is a dict, the downloaded bytes are also kept there under the artifact name
+    # returns False when the response is empty, raises requests.RequestException for error responses and
+    # for the login page, only complete 200 responses are saved and added to the manifest
+    if in_manifest(manifest, evaluation_id, artifact, path):
+        return True
+    lap = run_report.stage_timer('download', evaluation_id)
+    response = sess.get(url, stream = True)
+    try:
+        response.raise_for_status()
+        if logged_out(response):
+            raise requests.RequestException('login page instead of ' + artifact + ' for ' + evaluation_id,
+                response = response)
+    except requests.RequestException:
+        response.close()
+        raise
+    if response.status_code != 200:
+        response.close()
+        return False
+    temp_handle, temp_path = tempfile.mkstemp(suffix = '.part', dir = os.path.dirname(path))
+    size = 0
+    sha1 = hashlib.sha1()
+    chunks = []
+    try:
+        with os.fdopen(temp_handle, 'wb') as file:
+            for chunk in response.iter_content(CHUNK_SIZE, decode_unicode = not binary):
+                if isinstance(chunk, unicode): # text is saved as utf-8, like the decoded text before
+                    chunk = chunk.encode('utf-8')
+                file.write(chunk)
+                size += len(chunk)
+                sha1.update(chunk)
+                if contents is not None:
+                    chunks.append(chunk)
+    except:
+        os.remove(temp_path)
+        raise
+    finally:
+        response.close()
+    lap('fetch_' + artifact, size)
+    if size == 0:
+        os.remove(temp_path)
+        return False
+    os.chmod(temp_path, FILE_MODE) # mkstemp creates files readable by the owner only
+    replace_file(temp_path, path)
+    if contents is not None:
+        contents[artifact] = b''.join(chunks)
+    add_to_manifest(manifest, evaluation_id, artifact, path, size, sha1.hexdigest())
+    return True
+
+def spss_file_name(filename, evaluation_id, evaluation_title):
+    # name of the saved SPSS file, parse_results reads course, year, block and evaluation id from it
+    return filename.replace('-', '_') + '_' + evaluation_title + '_' + evaluation_id + '.txt'
+
+def download_evaluation(filename, evaluation_id, evaluation_title, sess, manifest, contents = None):
+    # request definitions, spss results and excel workbook with open answers for one course evaluation id and save to file
+    # if contents is a dict, the downloaded bytes are also kept there, see fetch_artifact
+    # returns None when all files are saved, otherwise a short description of the problem
+    url = SIN_HTTPS_URL + '/channel/quest/dump.html-nf?objid=' + evaluation_id
+    path = os.path.join(DEFINITION_DIR, evaluation_id + '.txt')
+    if not fetch_artifact(sess, manifest, url, path, evaluation_id, 'definitions', contents = contents):
+        logging.info('FAILURE: course definitions not not found, %s (eval_id: %s) skipped', filename, evaluation_id)
+        return 'defs not found'
+
+    url = SIN_HTTP_URL + '/channel/quest/report_spss.html-nf?objid=' + evaluation_id
+    spss_filename = filename.replace('-', '_')
+    path = os.path.join(SPSS_DIR, spss_file_name(filename, evaluation_id, evaluation_title))
+    if fetch_artifact(sess, manifest, url, path, evaluation_id, 'spss', contents = contents):
+        logging.info('SUCCESS: course: %s, evaluation id: %s, processed', spss_filename, evaluation_id)
+    else:
+        logging.info('FAILURE: course evaluation results not found, %s (eval_id: %s) skipped', filename, evaluation_id)
+        return 'results not found'
+
+    url = SIN_HTTP_URL + '/channel/quest/report_xls.html?objid=' + evaluation_id
+    path = os.path.join(EXCEL_DIR, evaluation_id + '.xls')
+    if not fetch_artifact(sess, manifest, url, path, evaluation_id, 'xls', binary = True, contents = contents):
+        return 'open answers not found'
+
+    return None
+
+def load_discovery_cache(path, ttl = None):
+    # load cache of course code -> channel id -> {evaluation id: title}, later records replace earlier ones
+    # records older than ttl (timedelta) are ignored
+    cache = {'path' : path, 'ttl' : ttl, 'courses' : {}, 'lock' : threading.Lock()}
+    for record in load_records(path):
+        cache['courses'][record['course']] = record
+    return cache
+
+def cached_discovery(cache, filename):
+    # return cached channel id and evaluation ids for course, None if not cached or expired
+    record = cache['courses'].get(filename)
+    if not record:
+        return None
+    if cache['ttl'] is not None:
+        fetched = datetime.strptime(record['fetched'], '%Y_%m_%d_%H:%M:%S')
+        if datetime.now() - fetched > cache['ttl']:
+            return None
+    return record
+
+def add_to_discovery_cache(cache, filename, channel_id, evaluation_id_collection):
+    record = {
+        'course' : filename,
+        'channel_id' : channel_id,
+        'evaluations' : evaluation_id_collection,
+        'fetched' : datetime.now().strftime('%Y_%m_%d_%H:%M:%S')
+        }
+    cache['courses'][filename] = record
+    append_record(cache['path'], cache['lock'], record)
+    return record
+
+def discover_evaluations(filename, sess):
+    # find channel id and course evaluation ids for course
+    # returns channel id, {evaluation id: title} and None, or None, None and a short description of the problem
     # request channel page for course and find channel id
-    print filename, ': get channel ID,',
-    url = 'http://ese.sin-online.nl/channel/pub/channel.html?mod=' + filename
-    channel_page = sess.get(url).text
+    lap = run_report.stage_timer('download', filename)
+    url = SIN_HTTP_URL + '/channel/pub/channel.html?mod=' + filename
+    response = sess.get(url)
+    channel_page = response.text
+    lap('channel_page', len(response.content))
     if channel_page:
-        soup_channel_page = BeautifulSoup(channel_page, 'lxml')
-        channel_title_tag = str(soup_channel_page.find('h2', class_ = 'channel_title'))
-        channel_title = re.findall('#([0-9]+)', channel_title_tag)
-        if channel_title:
-            channel_title = channel_title[0]
-            print 'done,',
-        else:
-            print 'no channel title found.'
+        channel_title = sin_pages.extract_channel_id(channel_page)
+        if not channel_title:
             logging.info('FAILURE, no channel title found, %s skipped', filename)
-            return None
+            return None, None, 'no channel title found.'
     else:
-        print 'problem loading channel page.'
         logging.info('FAILURE: problem loading channel page, %s skipped', filename)
-        return None
+        return None, None, 'problem loading channel page.'
 
     # request questionnaire page for found channel id and find course evaluation ids
-    print 'get course eval ID(s),',
-    url = 'http://ese.sin-online.nl/channel/quest/object.html?chid=' + channel_title
-    evaluation_page = sess.get(url).text
+    url = SIN_HTTP_URL + '/channel/quest/object.html?chid=' + channel_title
+    response = sess.get(url)
+    evaluation_page = response.text
+    lap('evaluation_page', len(response.content))
     if evaluation_page:
-        soup_evaluation_page = BeautifulSoup(evaluation_page, 'lxml')
-        evaluation_id_tags = soup_evaluation_page.find_all('a', string = re.compile('course evaluation|onderwijsevaluatie', re.IGNORECASE)) 
-        if evaluation_id_tags:
-            evaluation_id_collection = {}
-            for tag in evaluation_id_tags:
-                evaluation_id = re.findall('objid=([0-9]+)', str(tag))
-                if evaluation_id:
-                    evaluation_id_collection[evaluation_id[0]] = tag.text.lower()
-            print 'done,',
-        else:
-            print 'no course eval ID(s) found.'
+        evaluation_id_collection = sin_pages.extract_evaluation_ids(evaluation_page)
+        if not evaluation_id_collection:
             logging.info('FAILURE: no course eval ID(s) found, %s skipped', filename)
-            return None
+            return None, None, 'no course eval ID(s) found.'
     else:
-        print 'problem loading evaluation page.'
         logging.info('FAILURE: problem loading evaluation page, %s skipped', filename)
-        return None
+        return None, None, 'problem loading evaluation page.'
 
-    # request definitions for found course evaluation id(s) and save to file
-    print 'get defs,',
-    for evaluation_id in evaluation_id_collection:
-        url = 'https://ese.sin-online.nl/channel/quest/dump.html-nf?objid=' + evaluation_id
-        definitions = sess.get(url).text
-        if definitions:
-            with open(os.path.join(DEFINITION_DIR, evaluation_id + '.txt'), 'w') as file:
-                file.write(definitions.encode('utf-8'))
-        else:
-            print 'defs not found.'
-            logging.info('FAILURE: course definitions not not found, %s (eval_id: %s) skipped', filename, evaluation_id)
-            return None
-    print 'done,',
-    
-    # request spss downloader for found course evaluation id(s) and save to file
-    print 'get results,',
-    for evaluation_id in evaluation_id_collection:
-        url = 'http://ese.sin-online.nl/channel/quest/report_spss.html-nf?objid=' + evaluation_id
-        results = sess.get(url).text
-        if results:
-            filename = filename.replace('-', '_')
-            with open(os.path.join(SPSS_DIR, filename + '_' + evaluation_id_collection[evaluation_id] + '_' + evaluation_id + '.txt'), 'w') as file:
-                file.write(results.encode('utf-8'))
-                logging.info('SUCCESS: course: %s, evaluation id: %s, processed', filename, evaluation_id)
-        else:
-            logging.info('FAILURE: course evaluation results not found, %s (eval_id: %s) skipped', filename, evaluation_id)
-            return None
-    print 'done,',
-    
-    # request excel workbooks with open answers for found course evaluation id(s) and save to file
-    print 'get open answers,',
-    for evaluation_id in evaluation_id_collection:
-        url = 'http://ese.sin-online.nl/channel/quest/report_xls.html?objid=' + evaluation_id
-        xls = sess.get(url).content
-        if xls:
-            with open(os.path.join(EXCEL_DIR, evaluation_id + '.xls'), 'wb') as file:
-                file.write(xls)
-        else:
-            print 'open answers not found, ',
-    
-    print 'done.'
-
-# main
-if len(sys.argv) < 2:
-    print 'Provide name inputfile as command line argument'
-    exit()
-logging.info('Start log')
-start_time = datetime.now()
-sess = sin_login()
-files = open(sys.argv[1])
-for filename in files:
-    filename = filename.rstrip()
-    download_results(filename, sess)
-end_time = datetime.now()
-print 'Elapsed time:', str(end_time - start_time).split('.')[0]
\ No newline at end of file
+    return channel_title, evaluation_id_collection, None
+
+def fetch_evaluation(filename, evaluation_id, evaluation_title, downloader):
+    # download one evaluation, an optional downloader['on_evaluation'](spss file name, contents) is called
+    # when the results are saved, with the downloaded bytes if downloader['keep_contents'] is set (else None)
+    contents = {} if downloader.get('keep_contents') else None
+    problem = run_report.profiled(filename + '_' + evaluation_id, download_evaluation,
+        filename, evaluation_id, evaluation_title, downloader['sess'], downloader['manifest'], contents)
+    if downloader.get('on_evaluation') and problem in (None, 'open answers not found'): # open answers are optional
+        downloader['on_evaluation'](spss_file_name(filename, evaluation_id, evaluation_title), contents)
+    return problem
+
+def download_results(filename, downloader):
+    # find course evaluation ids, from the discovery cache if possible, and download their files
+    sess = downloader['sess']
+    record = cached_discovery(downloader['discovery_cache'], filename)
+    if record:
+        evaluation_id_collection = record['evaluations']
+    else:
+        channel_id, evaluation_id_collection, problem = discover_evaluations(filename, sess)
+        if problem:
+            return problem
+        if evaluation_id_collection:
+            add_to_discovery_cache(downloader['discovery_cache'], filename, channel_id, evaluation_id_collection)
+
+    # download the files for all found course evaluation id(s) in parallel on the evaluation pool
+    problems = downloader['evaluation_pool'].map(
+        lambda evaluation: fetch_evaluation(filename, evaluation[0], evaluation[1], downloader),
+        evaluation_id_collection.items())
+    problems = [problem for problem in problems if problem]
+    if problems:
+        return 'done, ' + ', '.join(problems) + '.'
+    return 'done.'
+
+def download_course(filename, downloader):
+    # download one course, print one status line per course so output of workers does not interleave
+    try:
+        status = run_report.profiled(filename, download_results, filename, downloader)
+    except requests.RequestException as error:
+        logging.info('FAILURE: request error (%s), %s skipped', error, filename)
+        status = 'request error.'
+    with PRINT_LOCK:
+        print filename, ':', status
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Download course evaluations from SIN-online')
+    parser.add_argument('inputfile', help = 'file with one course per line, format: VAKACODE-YEAR')
+    parser.add_argument('-w', '--workers', type = int, default = WORKERS,
+        help = 'number of concurrent downloads (default: %(default)s)')
+    parser.add_argument('--base-url',
+        help = 'download from this server instead of SIN-online, e.g. a local stand-in server')
+    parser.add_argument('--manifest', default = MANIFEST_FILE,
+        help = 'manifest of downloaded files, used to skip files on re-runs (default: %(default)s)')
+    parser.add_argument('--verify', action = 'store_true',
+        help = 'compare content hash of downloaded files with the manifest, not only the size')
+    parser.add_argument('--refresh', action = 'store_true',
+        help = 'ignore the manifest and download all files again')
+    parser.add_argument('--discovery-cache', default = DISCOVERY_CACHE_FILE,
+        help = 'cache of channel and evaluation ids per course (default: %(default)s)')
+    parser.add_argument('--cache-ttl', type = float,
+        help = 'days after which cached channel and evaluation ids are looked up again (default: never)')
+    parser.add_argument('--refresh-discovery', action = 'store_true',
+        help = 'ignore the discovery cache and look up all channel and evaluation ids again')
+    parser.add_argument('--report',
+        help = 'write per-request timings to this file, csv for a .csv file, json otherwise')
+    parser.add_argument('--profile',
+        help = 'profile the courses whose name contains this text, stats in logs/profile_*.prof')
+    args = parser.parse_args()
+    workers = max(args.workers, 1)
+    run_report.configure(bool(args.report), args.profile)
+    if args.base_url:
+        global SIN_HTTP_URL, SIN_HTTPS_URL
+        SIN_HTTP_URL = SIN_HTTPS_URL = args.base_url.rstrip('/')
+
+    # log file is set up here, so other scripts can import the functions in this module
+    logging.basicConfig(filename = os.path.join(os.getcwd(), 
+                                    LOGGING_DIR, 'download_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'), 
+                                    level = logging.INFO,
+                                    format = '%(asctime)s: %(message)s', datefmt = '%Y_%m_%d_%H:%M:%S')
+    logging.info('Start log')
+    start_time = datetime.now()
+    manifest = load_manifest(args.manifest, args.verify)
+    if args.refresh:
+        manifest['records'] = {}
+    ttl = timedelta(days = args.cache_ttl) if args.cache_ttl is not None else None
+    discovery_cache = load_discovery_cache(args.discovery_cache, ttl)
+    if args.refresh_discovery:
+        discovery_cache['courses'] = {}
+    sess = sin_login(workers)
+    with open(args.inputfile) as files:
+        filenames = [filename.rstrip() for filename in files if filename.strip()]
+    # separate pools for courses and evaluations, a course worker waits for its evaluations
+    course_pool = ThreadPool(workers)
+    downloader = {
+        'sess' : sess,
+        'evaluation_pool' : ThreadPool(workers),
+        'manifest' : manifest,
+        'discovery_cache' : discovery_cache
+        }
+    course_pool.map(lambda filename: download_course(filename, downloader), filenames)
+    course_pool.close()
+    downloader['evaluation_pool'].close()
+    end_time = datetime.now()
+    print 'Elapsed time:', str(end_time - start_time).split('.')[0]
+    if args.report:
+        run_report.write_report(args.report, 'download_results', (end_time - start_time).total_seconds())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# columnar export of the imported mc results and aggregates per course, question, lecturer and session form
+# usage: python export_results.py export OUT_DIR [--db sqlite:///test_evaldb.db] [--format parquet|npz]
+#   writes OUT_DIR/year=<EVL_JAAR>/period=<EVL_PERIODE>/results.parquet (or results.npz), one row per mc answer
+#   parquet needs pyarrow (pip install pyarrow), without it compressed numpy files (npz) are written
+# usage: python export_results.py aggregate OUT_DIR [--by course,question] [--year 2015] [--output aggregates.csv]
+#   count, mean, standard deviation and histogram of the answers per group, computed on whole columns with numpy
+import os # os interactions, from std library
+import re # regular expressions, from std library
+import csv # to write csv files, from std library
+import sys # for stdout, from std library
+import argparse # command line arguments, from std library
+
+import numpy # arrays and vectorized aggregates
+from sqlalchemy import select # for sql expressions
+
+import parse_results
+
+try:
+    import pyarrow # columnar files, optional
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# globals
+OUT_DIR = 'export'
+RESULTS_FILE = 'results' # file name in every partition dir, without extension
+EXTENSIONS = ('.parquet', '.npz')
+FETCH_SIZE = 10000 # rows per fetch from the database
+# exported columns, text columns are stored as unicode (missing texts as ''), the others as integers
+TEXT_COLUMNS = ['period', 'course', 'question_text', 'lecturer', 'session_form', 'student']
+COLUMNS = ['year', 'period', 'course', 'evaluation', 'question', 'question_text', 'lecturer', 'session_form',
+           'student', 'answer']
+GROUP_COLUMNS = ['year', 'period', 'course', 'evaluation', 'question', 'lecturer', 'session_form']
+PARTITION_VALUE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+# functions
+def results_query(tables):
+    # mc answers with evaluation, question, lecturer and session form, in the order of COLUMNS,
+    # sorted by year and period so every partition can be written as soon as it is read
+    table_evaluation = tables['table_evaluation']
+    table_questions = tables['table_questions']
+    table_evaluation_questions = tables['table_evaluation_questions']
+    table_mc_results = tables['table_mc_results']
+    return select([
+        table_evaluation.c.EVL_JAAR,
+        table_evaluation.c.EVL_PERIODE,
+        table_evaluation.c.EVL_VAK,
+        table_evaluation.c.EVL_SIN_ID,
+        table_questions.c.VRG_ID,
+        table_questions.c.VRG_TEXT,
+        table_evaluation_questions.c.EEV_PARAM_DOCENT_NAAM,
+        table_evaluation_questions.c.EEV_PARAM_SESSIE,
+        table_mc_results.c.RMC_STUDENT,
+        table_mc_results.c.RMC_ANTWOORD_SUBID
+        ]).select_from(table_mc_results
+            .join(table_evaluation_questions, table_mc_results.c.RMC_VRAAG == table_evaluation_questions.c.EEV_ID)
+            .join(table_evaluation, table_evaluation_questions.c.EEV_EVALUATIE == table_evaluation.c.EVL_ID)
+            .join(table_questions, table_evaluation_questions.c.EEV_VRAAG == table_questions.c.VRG_ID)
+        ).order_by(table_evaluation.c.EVL_JAAR, table_evaluation.c.EVL_PERIODE)
+
+def to_arrays(columns):
+    # lists per column to numpy arrays, text as unicode
+    arrays = {}
+    for name, values in columns.items():
+        if name in TEXT_COLUMNS:
+            arrays[name] = numpy.array([u'' if value is None else unicode(value) for value in values], dtype = unicode)
+        else:
+            arrays[name] = numpy.array([-1 if value is None else value for value in values], dtype = numpy.int64)
+    return arrays
+
+def partition_dir(out_dir, year, period):
+    return os.path.join(out_dir, 'year=%s' % year, 'period=%s' % PARTITION_VALUE.sub('_', unicode(period)))
+
+def partition_files(path):
+    # results files in partition dir path, in the order of EXTENSIONS
+    return [os.path.join(path, RESULTS_FILE + extension) for extension in EXTENSIONS
+            if os.path.exists(os.path.join(path, RESULTS_FILE + extension))]
+
+def partition_dirs(out_dir):
+    # existing year=/period= dirs of an export
+    if not os.path.isdir(out_dir):
+        return []
+    return [os.path.join(out_dir, year_dir, period_dir)
+            for year_dir in sorted(os.listdir(out_dir)) if year_dir.startswith('year=')
+            for period_dir in sorted(os.listdir(os.path.join(out_dir, year_dir)))]
+
+def write_partition(path, arrays, file_format):
+    # write columns of one partition as parquet or compressed npz, replaces the files of an earlier export
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for old_file in partition_files(path):
+        os.remove(old_file)
+    if file_format == 'parquet':
+        table = pyarrow.Table.from_arrays([pyarrow.array(arrays[name].tolist()) for name in COLUMNS], COLUMNS)
+        pyarrow.parquet.write_table(table, os.path.join(path, RESULTS_FILE + '.parquet'), compression = 'snappy')
+    else:
+        numpy.savez_compressed(os.path.join(path, RESULTS_FILE + '.npz'), **arrays)
+
+def write_columns(out_dir, partition, columns, file_format, written):
+    year, period = partition
+    path = partition_dir(out_dir, year, period)
+    write_partition(path, to_arrays(columns), file_format)
+    written.add(path)
+    print 'Exported year %s, period %s: %s answers' % (year, period, len(columns['answer']))
+    return len(columns['answer'])
+
+def export_results(connection, tables, out_dir, file_format):
+    # read the mc results in one pass and write a file per year and period, returns the number of rows
+    # rows come sorted by year and period, only the rows of the current partition are kept in memory
+    # files of partitions that are no longer in the database, e.g. of deleted evaluations, are removed at the end
+    partition = None
+    columns = None
+    total_rows = 0
+    written = set()
+    result = connection.execute(results_query(tables))
+    rows = result.fetchmany(FETCH_SIZE)
+    while rows:
+        for row in rows:
+            if (row[0], row[1]) != partition:
+                if columns:
+                    total_rows += write_columns(out_dir, partition, columns, file_format, written)
+                partition = (row[0], row[1])
+                columns = dict((name, []) for name in COLUMNS)
+            for name, value in zip(COLUMNS, row):
+                columns[name].append(value)
+        rows = result.fetchmany(FETCH_SIZE)
+    if columns:
+        total_rows += write_columns(out_dir, partition, columns, file_format, written)
+    for path in partition_dirs(out_dir):
+        if path not in written:
+            for old_file in partition_files(path):
+                os.remove(old_file)
+    return total_rows
+
+def read_partition(path):
+    # columns of one partition file as numpy arrays
+    if path.endswith('.npz'):
+        with numpy.load(path) as data:
+            return dict((name, data[name]) for name in data.files)
+    if pyarrow is None:
+        raise ImportError('pyarrow is needed to read ' + path)
+    table = pyarrow.parquet.read_table(path)
+    arrays = {}
+    for name in table.schema.names:
+        values = table.column(name).to_pylist()
+        arrays[name] = numpy.array(values, dtype = unicode if name in TEXT_COLUMNS else numpy.int64)
+    return arrays
+
+def read_export(out_dir, years = None):
+    # concatenated columns of all partitions, only the given years if years is set
+    # one file per partition, should a partition have both formats, the newest file is read
+    parts = []
+    for path in partition_dirs(out_dir):
+        year_dir = os.path.basename(os.path.dirname(path))
+        files = partition_files(path)
+        if not files or (years and int(year_dir[5:]) not in years):
+            continue
+        parts.append(read_partition(max(files, key = os.path.getmtime)))
+    if not parts:
+        return None
+    return dict((name, numpy.concatenate([part[name] for part in parts])) for name in COLUMNS)
+
+def group_codes(columns, by):
+    # group number per row for the combination of the by columns, and the first row of every group
+    # codes are made dense again after every column, so they stay below the number of rows times the
+    # number of values of one column instead of growing to the product of the numbers of values of all columns
+    codes = numpy.zeros(len(columns['answer']), dtype = numpy.int64)
+    for name in by:
+        values, inverse = numpy.unique(columns[name], return_inverse = True)
+        codes = numpy.unique(codes * len(values) + inverse, return_inverse = True)[1]
+    unique_codes, first_rows, codes = numpy.unique(codes, return_index = True, return_inverse = True)
+    return codes, first_rows
+
+def aggregate(columns, by):
+    # count, mean, standard deviation and answer histogram per group of the by columns
+    # returns group columns, statistics and the answer value of every histogram bin
+    answers = columns['answer']
+    codes, first_rows = group_codes(columns, by)
+    groups = len(first_rows)
+    counts = numpy.bincount(codes, minlength = groups)
+    sums = numpy.bincount(codes, weights = answers, minlength = groups)
+    squares = numpy.bincount(codes, weights = answers.astype(numpy.float64) ** 2, minlength = groups)
+    means = sums / counts
+    stds = numpy.sqrt(numpy.maximum(squares / counts - means ** 2, 0.0))
+    lowest = answers.min()
+    bins = answers.max() - lowest + 1
+    histograms = numpy.bincount(codes * bins + (answers - lowest), minlength = groups * bins).reshape(groups, bins)
+    aggregates = dict((name, columns[name][first_rows]) for name in by)
+    if 'question' in by:
+        aggregates['question_text'] = columns['question_text'][first_rows]
+    aggregates.update({'count' : counts, 'mean' : means, 'std' : stds, 'histogram' : histograms})
+    return aggregates, numpy.arange(lowest, lowest + bins)
+
+def write_aggregates(file, aggregates, bin_values, by):
+    # one csv row per group: group columns, count, mean, std and the count per answer value
+    names = list(by) + (['question_text'] if 'question' in by else [])
+    writer = csv.writer(file)
+    writer.writerow(names + ['count', 'mean', 'std'] + ['answer_%s' % value for value in bin_values])
+    for row in range(len(aggregates['count'])):
+        writer.writerow([unicode(aggregates[name][row]).encode('utf-8') for name in names] +
+            [aggregates['count'][row], '%.4f' % aggregates['mean'][row], '%.4f' % aggregates['std'][row]] +
+            aggregates['histogram'][row].tolist())
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Columnar export of mc results and aggregates per group')
+    subparsers = parser.add_subparsers(dest = 'command')
+    export_parser = subparsers.add_parser('export', help = 'write the mc results per year and period')
+    export_parser.add_argument('out_dir', nargs = '?', default = OUT_DIR)
+    export_parser.add_argument('--db', default = parse_results.DB_URL, help = 'database url (default: %(default)s)')
+    export_parser.add_argument('--reflect', action = 'store_true',
+        help = 'load the schema from the database instead of the schema defined in parse_results.py')
+    export_parser.add_argument('--format', choices = ['parquet', 'npz'],
+        help = 'file format (default: parquet if pyarrow is installed, otherwise npz)')
+    aggregate_parser = subparsers.add_parser('aggregate', help = 'count, mean, std and histogram per group')
+    aggregate_parser.add_argument('out_dir', nargs = '?', default = OUT_DIR)
+    aggregate_parser.add_argument('--by', default = 'course,question',
+        help = 'comma separated group columns, from: %s (default: %%(default)s)' % ', '.join(GROUP_COLUMNS))
+    aggregate_parser.add_argument('--year', type = int, action = 'append',
+        help = 'only this year, can be repeated (default: all years)')
+    aggregate_parser.add_argument('--output', help = 'csv file (default: stdout)')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        file_format = args.format or ('parquet' if pyarrow is not None else 'npz')
+        if file_format == 'parquet' and pyarrow is None:
+            print 'pyarrow is not installed, use --format npz or install pyarrow'
+            return
+        db = parse_results.create_db_engine(args.db)
+        tables = parse_results.reflect_db(db) if args.reflect else parse_results.define_db()
+        connection = db.connect()
+        total_rows = export_results(connection, tables, args.out_dir, file_format)
+        print 'Exported', total_rows, 'answers to', args.out_dir, 'as', file_format
+    else:
+        by = [name.strip() for name in args.by.split(',') if name.strip()]
+        unknown = [name for name in by if name not in GROUP_COLUMNS]
+        if unknown or not by:
+            print 'Unknown group column(s):', ', '.join(unknown) or '(none given)'
+            return
+        columns = read_export(args.out_dir, args.year)
+        if columns is None:
+            print 'No exported results found in', args.out_dir
+            return
+        aggregates, bin_values = aggregate(columns, by)
+        if args.output:
+            with open(args.output, 'wb') as file:
+                write_aggregates(file, aggregates, bin_values, by)
+        else:
+            write_aggregates(sys.stdout, aggregates, bin_values, by)
+
+if __name__ == '__main__':
+    main()
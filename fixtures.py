@@ -0,0 +1,171 @@
+# generator for synthetic SIN-online exports: SPSS syntax results, #Q definition dumps and open answer workbooks
+# usage: python fixtures.py OUT_DIR [--evaluations 100] [--respondents 200] [--questions 20] [--open-questions 2]
+#   --layout stub (default) writes the layout served by sin_stub_server.py, plus inputfile.txt for download_results.py
+#   --layout parse writes SIN_SPSS, SIN_definitions and SIN_excel as saved by download_results.py
+# the same arguments and --seed give the same files
+# open answer workbooks need xlwt (pip install xlwt), without it no workbooks are written
+import os # os interactions, from std library
+import io # to write files with explicit unicode encoding, from std library
+import json # to import / export json, from std library
+import random # for synthetic answers, from std library
+import argparse # command line arguments, from std library
+
+try:
+    import xlwt # to write MS Excel-files, optional
+except ImportError:
+    xlwt = None
+
+# globals
+YEAR = 15 # two digit year of the generated courses
+LECTURERS = ['Jansen', 'de Vries', 'van den Berg', 'Bakker', 'Visser', 'Smit']
+MC_QUESTIONS = [
+    u'De docent %s heeft de stof duidelijk uitgelegd',
+    u'The lecturer %s gives clear answers to questions',
+    u'Het werkcollege (sommen) sloot goed aan bij het hoorcollege',
+    u'De vaardigheden bijeenkomsten waren nuttig',
+    u'The tutorial sessions were well organised',
+    u'The exercise lectures helped me to prepare for the exam',
+    u'De studielast van dit vak was passend',
+    u'I learned a lot in this course',
+    u'De mentor %s heeft mij goed begeleid',
+    u'The course material was available on time'
+    ]
+OPEN_QUESTIONS = [u'Wat vond je goed aan dit vak?', u'What could be improved in this course?',
+                  u'Overige opmerkingen', u'Any other remarks?']
+OPEN_ANSWERS = [u'Duidelijke colleges', u'More practice exams please', u'Goede opdrachten',
+                u'The slides were hard to follow', u'Prima vak', u'Too much reading for one block']
+ANSWER_OPTIONS = [
+    [u'helemaal oneens', u'oneens', u'neutraal', u'eens', u'helemaal eens'],
+    [u'strongly disagree', u'disagree', u'neutral', u'agree', u'strongly agree']
+    ]
+TAGS = ['docent', 'werkcollege', 'vak', 'algemeen']
+MISSING_RATE = 0.1 # fraction of mc questions a respondent leaves open
+LAYOUTS = {
+    'stub' : {'spss' : 'spss', 'definitions' : 'definitions', 'excel' : 'excel'},
+    'parse' : {'spss' : 'SIN_SPSS', 'definitions' : 'SIN_definitions', 'excel' : 'SIN_excel'}
+    }
+
+# functions
+def question_text(rng, question_number):
+    text = MC_QUESTIONS[question_number % len(MC_QUESTIONS)]
+    if '%s' in text:
+        text = text % rng.choice(LECTURERS)
+    return text
+
+def spss_syntax(rng, respondents, questions):
+    # SPSS syntax export: results, variable labels and value labels
+    # returns lines and the question texts
+    question_ids = ['VAR%d' % (number + 1) for number in range(questions)]
+    texts = [question_text(rng, number) for number in range(questions)]
+    options = [ANSWER_OPTIONS[number % len(ANSWER_OPTIONS)] for number in range(questions)]
+    lines = [u'DATA LIST LIST(",") ' + u' '.join(question_ids) + u'.', u'BEGIN DATA.']
+    for respondent in range(respondents):
+        row = [u'%d' % (100000 + respondent)]
+        for option_list in options:
+            if rng.random() < MISSING_RATE:
+                row.append(u'-1')
+            else:
+                row.append(u'%d' % rng.randint(1, len(option_list)))
+        lines.append(u','.join(row))
+    lines += [u'END DATA.', u'', u'VARIABLE LABELS', u'']
+    for question_id, text in zip(question_ids, texts):
+        lines.append(u'\t%s\t%s' % (question_id, text))
+    lines += [u'', u'VALUE LABELS']
+    for question_id, option_list in zip(question_ids, options):
+        for option_number, option_text in enumerate(option_list, 1):
+            prefix = u'/%s\t' % question_id if option_number == 1 else u'\t'
+            lines.append(prefix + u'"%d"\t"%s"' % (option_number, option_text))
+    return lines, texts
+
+def definition_dump(rng, questions):
+    # definition dump, one #Q<number><tag> line per mc question
+    lines = []
+    for number in range(1, questions + 1):
+        lines.append(u'#Q%d%s<br>%s' % (number, rng.choice(TAGS), u'definition of question %d' % number))
+    return lines
+
+def write_workbook(path, rng, respondents, texts, open_questions):
+    # workbook with a first sheet, answers per respondent in sheet 1 and the question list in sheet 2
+    book = xlwt.Workbook(encoding = 'utf-8')
+    book.add_sheet('Overzicht')
+    answersheet = book.add_sheet('Antwoorden')
+    questionsheet = book.add_sheet('Vragen')
+    open_ids = range(len(texts) + 1, len(texts) + open_questions + 1)
+    answersheet.write(0, 0, 'respondent')
+    for column, question_id in enumerate(open_ids, 1):
+        answersheet.write(0, column, u'Vraag %d' % question_id)
+    for respondent in range(respondents):
+        answersheet.write(respondent + 1, 0, 100000 + respondent)
+        for column in range(1, open_questions + 1):
+            if rng.random() < 0.5:
+                answersheet.write(respondent + 1, column, rng.choice(OPEN_ANSWERS))
+    questionsheet.write(0, 0, 'id')
+    questionsheet.write(0, 1, 'text')
+    questionsheet.write(0, 2, 'type')
+    for row, text in enumerate(texts, 1):
+        questionsheet.write(row, 0, float(row))
+        questionsheet.write(row, 1, text)
+        questionsheet.write(row, 2, 'MC')
+    for row, question_id in enumerate(open_ids, len(texts) + 1):
+        questionsheet.write(row, 0, float(question_id))
+        questionsheet.write(row, 1, OPEN_QUESTIONS[question_id % len(OPEN_QUESTIONS)])
+        questionsheet.write(row, 2, 'OPEN')
+    book.save(path)
+
+def write_lines(path, lines):
+    with io.open(path, 'w', encoding = 'utf-8') as file:
+        file.write(u'\n'.join(lines) + u'\n')
+
+def generate_fixtures(out_dir, evaluations = 100, respondents = 200, questions = 20, open_questions = 2,
+                      evaluations_per_course = 1, seed = 1, layout = 'stub'):
+    # write evaluations in layout to out_dir, return {course: {'channel_id', 'evaluations' : {id: title}}}
+    rng = random.Random(seed)
+    dirs = dict((artifact, os.path.join(out_dir, name)) for artifact, name in LAYOUTS[layout].items())
+    for path in dirs.values():
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    if xlwt is None and open_questions:
+        print 'xlwt not installed, no open answer workbooks written'
+    courses = {}
+    for number in range(evaluations):
+        course_number = number // max(evaluations_per_course, 1)
+        course = 'FEM1%04d-%d' % (course_number, YEAR)
+        evaluation_id = str(100000 + number)
+        block = number % 5 + 1
+        title = u'onderwijsevaluatie blok %d 20%d-20%d' % (block, YEAR, YEAR + 1)
+        courses.setdefault(course, {'channel_id' : str(5000 + course_number), 'evaluations' : {}})
+        courses[course]['evaluations'][evaluation_id] = title
+        lines, texts = spss_syntax(rng, respondents, questions)
+        if layout == 'stub':
+            spss_path = os.path.join(dirs['spss'], evaluation_id + '.txt')
+        else: # file name as saved by download_results
+            spss_path = os.path.join(dirs['spss'], course.replace('-', '_') + '_' + title + '_' + evaluation_id + '.txt')
+        write_lines(spss_path, lines)
+        write_lines(os.path.join(dirs['definitions'], evaluation_id + '.txt'),
+            definition_dump(rng, questions))
+        if xlwt is not None and open_questions:
+            write_workbook(os.path.join(dirs['excel'], evaluation_id + '.xls'), rng, respondents, texts, open_questions)
+    if layout == 'stub':
+        with open(os.path.join(out_dir, 'courses.txt'), 'w') as file:
+            json.dump(courses, file, indent = 1, sort_keys = True)
+        with open(os.path.join(out_dir, 'inputfile.txt'), 'w') as file:
+            file.write(''.join(course + '\n' for course in sorted(courses)))
+    return courses
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Generate synthetic SIN-online exports')
+    parser.add_argument('out_dir')
+    parser.add_argument('--evaluations', type = int, default = 100, help = 'default: %(default)s')
+    parser.add_argument('--respondents', type = int, default = 200, help = 'per evaluation, default: %(default)s')
+    parser.add_argument('--questions', type = int, default = 20, help = 'mc questions, default: %(default)s')
+    parser.add_argument('--open-questions', type = int, default = 2, help = 'default: %(default)s')
+    parser.add_argument('--evaluations-per-course', type = int, default = 1, help = 'default: %(default)s')
+    parser.add_argument('--seed', type = int, default = 1, help = 'default: %(default)s')
+    parser.add_argument('--layout', choices = sorted(LAYOUTS), default = 'stub', help = 'default: %(default)s')
+    args = parser.parse_args()
+    courses = generate_fixtures(args.out_dir, args.evaluations, args.respondents, args.questions,
+        args.open_questions, args.evaluations_per_course, args.seed, args.layout)
+    print 'Written', args.evaluations, 'evaluations of', len(courses), 'courses to', args.out_dir
+
+if __name__ == '__main__':
+    main()
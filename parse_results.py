@@ -2,15 +2,24 @@
 import re # for regular expressions, from std library
 import os # for os level functions, from std library
 import json # to import / export json, from std library
+import hashlib # content hashes for the import ledger, from std library
 import logging # enables logging, from std library
 import io # to open files with explicit unicode encoding, from std library
-from collections import Counter # special dictionary for counting stuff, from std library
+import multiprocessing # to parse files in parallel processes, from std library
+from array import array # compact typed arrays for results, from std library
+from itertools import izip # from std library
+from collections import Counter, OrderedDict # special dictionaries for counting stuff and keeping order, from std library
 from datetime import datetime # for dates + times, from std. library
+import argparse # command line arguments, from std library
 
 from langdetect import detect # to detect question language
-from sqlalchemy import create_engine, Table, MetaData, select # for sql expressions
+from sqlalchemy import create_engine, Table, Column, ForeignKey, MetaData, select, inspect # for sql expressions
+from sqlalchemy import event # engine events, for the sqlite settings
+from sqlalchemy import Integer, String, Text # column types
 import xlrd # to read MS Excel-files
 
+import run_report # per-stage timings and profiling
+
 # globals
 # dirs
 SPSS_DIR = 'SIN_SPSS'
@@ -22,19 +31,175 @@ LOGGING_DIR = 'logs'
 # vars
 NA_VALUE = None
 FAC = 'FEW'
+DB_URL = 'sqlite:///test_evaldb.db'
+BATCH_SIZE = 1000 # rows per multi-row insert
+FILES_PER_TRANSACTION = 1 # files per outer transaction, every file gets a savepoint when more than 1
+SQLITE_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SQLITE_SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+WORKERS = multiprocessing.cpu_count() # default number of parse processes
+LANGUAGE_CACHE_FILE = 'language_cache.txt' # detected language per question text, kept between runs
+LANGUAGE_CACHE_SIZE = 50000 # max number of question texts in the language cache
+WORKER_LANGUAGE_CACHE = None # language cache of a parse process, set by init_parse_worker
+WRITE_DEBUG_FILES = False # write parsed and keyed files to debug_files, set with --debug-files
+MISSING = -1 # result value for questions without answer
+LEDGER_HASH_COLUMNS = {'spss' : 'IMP_HASH_SPSS', 'definitions' : 'IMP_HASH_DEF', 'xls' : 'IMP_HASH_XLS'}
+SKIP_STATUS = ('unchanged', 'unrecorded') # import ledger status of files that are not parsed again
 
-# set up logging
-logging.basicConfig(filename = os.path.join(os.getcwd(), 
-                        LOGGING_DIR, 'parse_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'), 
-                        level = logging.INFO,
-                        format = '%(asctime)s: %(message)s', datefmt = '%Y_%m_%d_%H:%M:%S')
+# regular expressions, compiled once
+# use raw string notation for regular expressions, prevents a lot of escaping backslashes
+PARSE_NAME = re.compile(r'''
+    mentor\s(\S\S.+?)(?:\bheeft\b|\bhas\b|$)|
+    docent\s(\S\S.+?)(?:\bheeft\b|\bmaakt\b|\bgeeft\b|$)|
+    lecturer\s(\S\S.+?)(?:\bhas\b|\bmakes\b|\bgives\b|\bprovides\b|\bis\b|$)''',
+    re.IGNORECASE | re.VERBOSE)
+PARSE_SESSION_FORM = re.compile(r'''
+    (sommen|vaardigheden|(?<![+])practic|mentor)|
+    (skills|(?<![+])tutorial|exercise|mentor)''',
+    re.IGNORECASE | re.VERBOSE)
+PUNCTUATION = re.compile('[^A-Za-z %]')
 
 # functions
 def write_json_file(table, writefile):
-    outfile = open(writefile + '.txt', 'w')
-    json.dump(table, outfile, indent = 4)
+    with open(writefile + '.txt', 'w') as outfile:
+        json.dump(table, outfile, default = list) # result arrays are written as lists
+    
+def define_db():
+    # EVAL_* schema defined in code, no reflection needed at startup
+    # indexes on the columns the importer and later queries look up
+    tables = {}
+    meta = MetaData()
+    tables['table_evaluation'] = Table('EVAL_EVALUATIE', meta,
+        Column('EVL_ID', Integer, primary_key = True),
+        Column('EVL_JAAR', Integer),
+        Column('EVL_PERIODE', String(50)),
+        Column('EVL_VAK', String(50)),
+        Column('EVL_FAC', String(10)),
+        Column('EVL_SIN_ID', Integer, index = True))
+    tables['table_questions'] = Table('EVAL_VRAAG', meta,
+        Column('VRG_ID', Integer, primary_key = True),
+        Column('VRG_TEXT', Text, index = True),
+        Column('VRG_TAG', String(255)),
+        Column('VRG_TAAL', String(10)),
+        Column('VRG_TYPE', String(10)),
+        Column('VRG_SCHAAL', String(50)),
+        Column('VRG_N_ANTW', Integer),
+        Column('VRG_FAC', String(10)))
+    tables['table_evaluation_questions'] = Table('EVAL_EVALUATIE_VRAAG', meta,
+        Column('EEV_ID', Integer, primary_key = True),
+        Column('EEV_EVALUATIE', Integer, ForeignKey('EVAL_EVALUATIE.EVL_ID'), index = True),
+        Column('EEV_VRAAG', Integer, ForeignKey('EVAL_VRAAG.VRG_ID'), index = True),
+        Column('EEV_PARAM_DOCENT_NAAM', String(255)),
+        Column('EEV_PARAM_DOCENT', String(255)),
+        Column('EEV_PARAM_SESSIE', String(50)),
+        Column('EEV_ORDERID', Integer),
+        Column('EEV_FAC', String(10)))
+    tables['table_mc_answer_options'] = Table('EVAL_VRAAG_ANTW_MC', meta,
+        Column('AMC_ID', Integer, primary_key = True),
+        Column('AMC_VRAAG', Integer, ForeignKey('EVAL_VRAAG.VRG_ID'), index = True),
+        Column('AMC_TEXT', String(255)),
+        Column('AMC_ORDERID', Integer),
+        Column('AMC_FAC', String(10)))
+    tables['table_open_answer_options'] = Table('EVAL_VRAAG_ANTW_OPEN', meta,
+        Column('AOP_ID', Integer, primary_key = True),
+        Column('AOP_VRAAG', Integer, ForeignKey('EVAL_VRAAG.VRG_ID'), index = True),
+        Column('AOP_FAC', String(10)))
+    tables['table_mc_results'] = Table('EVAL_EVALUATIE_RESULT_MC', meta,
+        Column('RMC_ID', Integer, primary_key = True),
+        Column('RMC_STUDENT', String(50)),
+        Column('RMC_ANTWOORD_SUBID', Integer),
+        Column('RMC_ANTWOORD_ID', Integer, ForeignKey('EVAL_VRAAG.VRG_ID'), index = True),
+        Column('RMC_VRAAG', Integer, ForeignKey('EVAL_EVALUATIE_VRAAG.EEV_ID'), index = True),
+        Column('RMC_FAC', String(10)))
+    tables['table_open_results'] = Table('EVAL_EVALUATIE_RESULT_OPEN', meta,
+        Column('ROP_ID', Integer, primary_key = True),
+        Column('ROP_STUDENT', String(50)),
+        Column('ROP_CONTENT', Text),
+        Column('ROP_ANTWOORD_ID', Integer, ForeignKey('EVAL_VRAAG.VRG_ID'), index = True),
+        Column('ROP_VRAAG', Integer, ForeignKey('EVAL_EVALUATIE_VRAAG.EEV_ID'), index = True),
+        Column('ROP_FAC', String(10)))
+    tables['table_import_ledger'] = define_import_ledger(meta, tables['table_evaluation'])
+    
+    return tables
+
+def define_import_ledger(meta, table_evaluation):
+    # source file and content hashes of every imported evaluation, to skip unchanged files before parsing
+    # IMP_EVALUATIE refers to the primary key of table_evaluation, whatever its name in a reflected database
+    return Table('EVAL_IMPORT', meta,
+        Column('IMP_ID', Integer, primary_key = True),
+        Column('IMP_BESTAND', String(255)),
+        Column('IMP_SIN_ID', Integer, index = True),
+        Column('IMP_EVALUATIE', Integer, ForeignKey(list(table_evaluation.primary_key.columns)[0]), index = True),
+        Column('IMP_HASH_SPSS', String(40)),
+        Column('IMP_HASH_DEF', String(40)),
+        Column('IMP_HASH_XLS', String(40)),
+        Column('IMP_DATUM', String(20)))
+
+def create_db_engine(url, journal_mode = None, synchronous = None, cache_size = None):
+    # engine for url, sqlite connections get the given pragmas when they are opened (None keeps the sqlite default)
+    # pysqlite begins and commits transactions on its own, which breaks savepoints,
+    # so for sqlite its transaction handling is switched off and sqlalchemy emits BEGIN itself
+    db = create_engine(url, echo = False)
+    if db.dialect.name != 'sqlite':
+        return db
+    pragmas = []
+    if journal_mode:
+        pragmas.append('PRAGMA journal_mode = %s' % journal_mode)
+    if synchronous:
+        pragmas.append('PRAGMA synchronous = %s' % synchronous)
+    if cache_size is not None:
+        pragmas.append('PRAGMA cache_size = %d' % cache_size) # pages, or KiB when negative
+    
+    @event.listens_for(db, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
     
+    @event.listens_for(db, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+    
+    return db
+
+def create_db(db, tables):
+    # create missing tables and add missing indexes to existing tables
+    meta = tables['table_evaluation'].metadata
+    inspector = inspect(db)
+    existing_tables = inspector.get_table_names()
+    meta.create_all(db)
+    for table in meta.sorted_tables:
+        if table.name not in existing_tables:
+            print 'Created table', table.name
+            continue
+        existing_indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(db)
+                print 'Created index', index.name
+
+def schema_differences(db, tables):
+    # tables and columns of the define_db schema that are missing in the database, as readable lines
+    # the import ledger is left out, main creates it when missing
+    inspector = inspect(db)
+    existing_tables = dict((name.lower(), name) for name in inspector.get_table_names())
+    differences = []
+    for key, table in sorted(tables.items()):
+        if key == 'table_import_ledger':
+            continue
+        if table.name.lower() not in existing_tables:
+            differences.append('table %s not found' % table.name)
+            continue
+        existing_columns = set(column['name'].lower()
+                               for column in inspector.get_columns(existing_tables[table.name.lower()]))
+        missing_columns = [column.name for column in table.columns if column.name.lower() not in existing_columns]
+        if missing_columns:
+            differences.append('table %s has no column(s) %s' % (table.name, ', '.join(missing_columns)))
+    return differences
+
 def reflect_db(db):
+    # load schema from the database, for databases created outside define_db
     tables = {}
     meta = MetaData()
     tables['table_evaluation'] = Table('EVAL_EVALUATIE', meta, autoload = True, autoload_with = db)
@@ -44,134 +209,429 @@ def reflect_db(db):
     tables['table_open_answer_options'] = Table('EVAL_VRAAG_ANTW_OPEN', meta, autoload = True, autoload_with = db)
     tables['table_mc_results'] = Table('EVAL_EVALUATIE_RESULT_MC', meta, autoload = True, autoload_with = db)
     tables['table_open_results'] = Table('EVAL_EVALUATIE_RESULT_OPEN', meta, autoload = True, autoload_with = db)
+    if 'EVAL_IMPORT' in inspect(db).get_table_names():
+        tables['table_import_ledger'] = Table('EVAL_IMPORT', meta, autoload = True, autoload_with = db)
+    else: # databases from before the import ledger, the table is created by main
+        tables['table_import_ledger'] = define_import_ledger(meta, tables['table_evaluation'])
     
     return tables
     
-def parse_spss_file(file):
-    # parse SPSS files and return dict parsed
-    parsed = {}
-    lines = io.open(os.path.join(SPSS_DIR, file), encoding = 'utf-8').read().splitlines()
+def mc_question_key(text, answer_options):
+    # canonical key for mc questions: question text + answer options
+    return (text, frozenset(answer_options.items()))
 
-    # parse question_ids
-    if len(lines) == 0:
-        logging.info('File contains no usable data, file skipped')
+def load_question_index(connection, tables):
+    # load all questions once per run, question matching in insert_data is then a dict lookup
+    # 'mc' maps question text + answer options to VRG_ID, 'open' maps question text to VRG_ID (of any question type)
+    # 'pending' holds the keys added since the last commit, removed again on rollback
+    question_index = {'mc' : {}, 'open' : {}, 'pending' : []}
+    sql_select = select([tables['table_questions'], 
+                         tables['table_mc_answer_options']]).where(
+                         tables['table_questions'].c.VRG_ID == 
+                         tables['table_mc_answer_options'].c.AMC_VRAAG)
+    db_question_data = {}
+    for row in connection.execute(sql_select):
+        db_question_data.setdefault(
+            row['VRG_ID'],
+            (row['VRG_TEXT'], {}))[1][row['AMC_ORDERID']] = row['AMC_TEXT']
+    for db_question_id in sorted(db_question_data):
+        text, answer_options = db_question_data[db_question_id]
+        question_index['mc'].setdefault(mc_question_key(text, answer_options), db_question_id)
+    for row in connection.execute(select([tables['table_questions']])):
+        question_index['open'].setdefault(row['VRG_TEXT'], row['VRG_ID'])
+    
+    return question_index
+
+def add_to_question_index(question_index, content, key_question):
+    # add newly inserted question, an open question can also match a new mc question with the same text
+    if content['type'] == 'mc':
+        key = mc_question_key(content['text'], content['answer_options'])
+        if key not in question_index['mc']:
+            question_index['mc'][key] = key_question
+            question_index['pending'].append(('mc', key))
+    if content['text'] not in question_index['open']:
+        question_index['open'][content['text']] = key_question
+        question_index['pending'].append(('open', content['text']))
+
+def commit_question_index(question_index):
+    question_index['pending'] = []
+
+def rollback_question_index(question_index, mark = 0):
+    # forget questions of a rolled back transaction, or of a rolled back savepoint:
+    # mark is the length of 'pending' when the savepoint was started
+    for kind, key in question_index['pending'][mark:]:
+        del question_index[kind][key]
+    del question_index['pending'][mark:]
+
+def file_evaluation_id(file):
+    # SIN evaluation id from the SPSS file name, None if the file name has none
+    try:
+        return int(file[:-4].split('_')[-1])
+    except ValueError:
         return None
-    question_ids = [col for col in lines[0].split(')')[-1][:-1].strip().split(' ')]
-        
-    # parse results
-    line_num = 2
-    for line in lines[line_num:]:
-        line_num += 1
-        if line == 'END DATA.':
-            break
-        row = line.split(',')
-        respondent_id = row[0]
-        question_results = row[1:]
-        for question_id, question_result in zip(question_ids, question_results):
-            question_result = int(question_result)
-            if question_id not in parsed:
-                parsed[question_id] = {
-                'text' : NA_VALUE,
-                'tag' : NA_VALUE,
-                'language' : NA_VALUE,
-                'person' : NA_VALUE,
-                'session_form' : NA_VALUE,
-                'question_ordernr' : NA_VALUE,
-                'type' : NA_VALUE,
-                'db_question_id' : NA_VALUE,
-                'answer_options' : {},
-                'results' : {}
-                }
-            parsed[question_id]['results'][respondent_id] = question_result
-    if len(parsed) == 0:
-        logging.info('File contains no usable results, file skipped')
+
+def file_sha1(path):
+    # sha1 of the file content, None for missing files
+    if not os.path.exists(path):
         return None
- 
-    # parse questions, incl name, sessionform and question order
-    line_num += 3
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def input_paths(file):
+    # paths of the SPSS, definition and excel file of an evaluation, by artifact name
+    SIN_evaluation_id = file[:-4].split('_')[-1]
+    return {
+        'spss' : os.path.join(SPSS_DIR, file),
+        'definitions' : os.path.join(DEFINITION_DIR, SIN_evaluation_id + '.txt'),
+        'xls' : os.path.join(EXCEL_DIR, SIN_evaluation_id + '.xls')
+        }
+
+def import_hashes(file, contents = None):
+    # content hashes of the SPSS, definition and excel file of an evaluation, as ledger columns
+    # contents holds the bytes of artifacts handed over in memory, other artifacts are read from disk
+    contents = contents or {}
+    hashes = {}
+    for artifact, path in input_paths(file).items():
+        if artifact in contents:
+            hashes[LEDGER_HASH_COLUMNS[artifact]] = hashlib.sha1(contents[artifact]).hexdigest()
+        else:
+            hashes[LEDGER_HASH_COLUMNS[artifact]] = file_sha1(path)
+    return hashes
+
+def load_import_ledger(connection, tables):
+    # imported evaluations by EVL_SIN_ID, with the ledger row if there is one
+    # evaluations imported before the ledger only have 'IMP_EVALUATIE', ledger rows of deleted evaluations are left out
+    ledger = {}
+    table_evaluation = tables['table_evaluation']
+    primary_key = list(table_evaluation.primary_key.columns)[0]
+    for row in connection.execute(select([table_evaluation.c.EVL_SIN_ID, primary_key])):
+        ledger[row['EVL_SIN_ID']] = {'IMP_EVALUATIE' : row[primary_key]}
+    for row in connection.execute(select([tables['table_import_ledger']])):
+        if ledger.get(row['IMP_SIN_ID'], {}).get('IMP_EVALUATIE') == row['IMP_EVALUATIE']:
+            ledger[row['IMP_SIN_ID']] = dict(row)
+    
+    return ledger
+
+def write_import_ledger(connection, tables, file, key_evaluation, hashes):
+    # record an imported file, replaces the previous record of the evaluation
+    table_import_ledger = tables['table_import_ledger']
+    SIN_evaluation_id = file_evaluation_id(file)
+    connection.execute(table_import_ledger.delete().where(table_import_ledger.c.IMP_SIN_ID == SIN_evaluation_id))
+    row = {
+        'IMP_BESTAND' : file,
+        'IMP_SIN_ID' : SIN_evaluation_id,
+        'IMP_EVALUATIE' : key_evaluation,
+        'IMP_DATUM' : datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    row.update(hashes)
+    connection.execute(table_import_ledger.insert().values(row))
+
+def check_import_ledger(ledger, file, hashes, reimport = False):
+    # import ledger status of file: 'new', 'changed' since the last import, 'unchanged' or
+    # 'unrecorded' for evaluations imported before the ledger, files with a SKIP_STATUS are not parsed again
+    entry = ledger.get(file_evaluation_id(file))
+    if entry is None or reimport:
+        return 'new' if entry is None else 'changed'
+    if 'IMP_ID' not in entry:
+        return 'unrecorded'
+    if any(entry[column] != content_hash for column, content_hash in hashes.items()):
+        logging.info('File \'%s\' changed since last import, file will be re-imported', file)
+        return 'changed'
+    return 'unchanged'
+
+def skip_file(connection, tables, ledger, file, hashes, status):
+    # record evaluations imported before the ledger with their current files, log skipped file
+    if status == 'unrecorded':
+        write_import_ledger(connection, tables, file, ledger[file_evaluation_id(file)]['IMP_EVALUATIE'], hashes)
+    logging.info('SKIPPED: file \'%s\' unchanged since last import', file)
+
+def delete_evaluation(connection, tables, key_evaluation):
+    # delete an imported evaluation with its evaluation questions and results, for re-imports
+    # questions and answer options can be shared with other evaluations and are kept
+    table_evaluation_questions = tables['table_evaluation_questions']
+    evaluation_questions = select([list(table_evaluation_questions.primary_key.columns)[0]]).where(
+                                  table_evaluation_questions.c.EEV_EVALUATIE == key_evaluation)
+    table_mc_results = tables['table_mc_results']
+    connection.execute(table_mc_results.delete().where(table_mc_results.c.RMC_VRAAG.in_(evaluation_questions)))
+    table_open_results = tables['table_open_results']
+    connection.execute(table_open_results.delete().where(table_open_results.c.ROP_VRAAG.in_(evaluation_questions)))
+    connection.execute(table_evaluation_questions.delete().where(
+                       table_evaluation_questions.c.EEV_EVALUATIE == key_evaluation))
+    table_evaluation = tables['table_evaluation']
+    connection.execute(table_evaluation.delete().where(
+                       list(table_evaluation.primary_key.columns)[0] == key_evaluation))
+
+def import_file(file, parsed, log_records, connection, tables, question_index, ledger, hashes, batch_size = BATCH_SIZE):
+    # import parsed file in its own transaction, the previous import of a changed file is replaced
+    # within an outer transaction of several files the file gets a savepoint, rolled back on import errors,
+    # its questions stay pending in the question index until the outer transaction is committed
+    # log_records of the parse process are written first, returns True when the file is imported
+    logging.info('Importing file \'%s\'', file)
+    for level, message in log_records:
+        logging.log(level, message)
+    if not parsed:
+        return False
+    logging.debug('File parsed')
+    mark = len(question_index['pending'])
+    nested = connection.in_transaction()
+    if nested:
+        transaction = connection.begin_nested()
+    else:
+        transaction = connection.begin()
+    previous_import = ledger.get(file_evaluation_id(file))
+    if previous_import is not None:
+        delete_evaluation(connection, tables, previous_import['IMP_EVALUATIE'])
+        logging.info('Previous import of the evaluation deleted')
+    key_evaluation = insert_data(file, parsed, connection, tables, question_index, batch_size)
+    if key_evaluation:
+        write_import_ledger(connection, tables, file, key_evaluation, hashes)
+        # transaction.rollback() # for debugging, rollback after every succesfull entry
+        transaction.commit()
+        if not nested:
+            commit_question_index(question_index)
+        logging.info('SUCCES: file imported')
+        return True
+    transaction.rollback()
+    rollback_question_index(question_index, mark)
+    logging.info('FAILURE: import error, file not imported')
+    return False
+
+def load_language_cache(path, size = LANGUAGE_CACHE_SIZE):
+    # load cache of normalized question text -> language, least recently used first
+    # 'used' collects the lookups of the current file until they are merged into 'languages'
+    language_cache = {'path' : path, 'size' : size, 'languages' : OrderedDict(), 'used' : {}}
+    if path and os.path.exists(path):
+        with open(path) as file:
+            for text, language in json.load(file):
+                language_cache['languages'][text] = language
+    return language_cache
+
+def merge_language_cache(language_cache, used):
+    # move used texts to the most recently used end, drop least recently used texts above size
+    languages = language_cache['languages']
+    for text, language in used.items():
+        languages.pop(text, None)
+        languages[text] = language
+    while len(languages) > language_cache['size']:
+        languages.popitem(last = False)
+
+def save_language_cache(language_cache):
+    # write to temporary file first, an interrupted write never leaves a half-written cache
+    temp_path = language_cache['path'] + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(language_cache['languages'].items(), file)
+    if os.path.exists(language_cache['path']):
+        os.remove(language_cache['path'])
+    os.rename(temp_path, language_cache['path'])
+
+def detect_file_language(texts, language_cache):
+    # majority vote of the languages of texts, cached languages are counted first
+    # detection stops when the leading language can no longer be overtaken
+    language_collection = Counter()
+    uncached = []
+    for text in texts:
+        key = ' '.join(text.lower().split())
+        language = language_cache['used'].get(key) or language_cache['languages'].get(key)
+        if language:
+            language_cache['used'][key] = language
+            language_collection[language] += 1
+        else:
+            uncached.append((key, text))
+    remaining = len(uncached)
+    for key, text in uncached:
+        if language_collection:
+            counts = [count for language, count in language_collection.most_common(2)] + [0]
+            if counts[0] > counts[1] + remaining:
+                break
+        language = language_cache['used'].get(key) or detect(text) # same text can occur twice in a file
+        language_cache['used'][key] = language
+        language_collection[language] += 1
+        remaining -= 1
+    return language_collection.most_common()[0][0]
+
+def parse_question_text(text):
+    # find person and session form in question text, return cleaned text, person and session form
+    person = NA_VALUE
+    name = PARSE_NAME.findall(text)
+    if name:
+        name = ''.join(name[0]).strip()
+        if not name.startswith('heb'): # for name parsing edge cases
+            text = text.replace(name, '%p')
+            person = name
+
+    text = PUNCTUATION.sub('', text) # remove punctuation after parse_name to retain punctuation in name (except %)
+    
+    session_form = PARSE_SESSION_FORM.findall(text)
+    if session_form:
+        session_form = ''.join(session_form[0]).strip().lower()
+        if session_form == 'sommen' or session_form == 'exercise':
+            session_form = 'exercise lecture'
+        elif session_form == 'vaardigheden' or session_form == 'skills':
+            session_form = 'skills tutorial'
+        elif session_form == 'mentor':
+            session_form = 'guidance'
+        else:
+            session_form = 'tutorial'
+        # replacing the session form in the question text is too complicated for now, implement later
+    else:
+        session_form = NA_VALUE
+    
+    return text, person, session_form
+
+def new_question(results):
+    return {
+        'text' : NA_VALUE,
+        'tag' : NA_VALUE,
+        'language' : NA_VALUE,
+        'person' : NA_VALUE,
+        'session_form' : NA_VALUE,
+        'question_ordernr' : NA_VALUE,
+        'type' : NA_VALUE,
+        'db_question_id' : NA_VALUE,
+        'answer_options' : {},
+        'results' : results
+        }
+
+def add_result_columns(questions, question_ids, answered, results):
+    # split row by row results into one array per question, rows hold a result for every question id
+    # only the first answered question ids get a question, later columns have no result in any row
+    width = len(question_ids)
+    for column_index, question_id in enumerate(question_ids[:answered]):
+        questions[question_id] = new_question(results[column_index::width])
+
+def parse_spss_syntax(lines):
+    # parse SPSS syntax export in a single pass over lines and return dict parsed
+    # sections: header with question_ids, BEGIN DATA, results up to END DATA, 3 lines,
+    # question labels up to an empty line, 1 line, answer options up to the end of the file
+    # parsed is columnar: 'respondents' lists the respondent ids, the 'results' of every mc question
+    # in 'questions' is an int array with one answer per respondent, MISSING if not answered
+    parsed = {'respondents' : [], 'questions' : {}}
+    respondents = parsed['respondents']
+    questions = parsed['questions']
+    results = array('i') # results row by row, split into one array per question at the end of the data
+    question_ids = None
+    state = 'header'
+    skip = 0
     question_ordernr = 1
-    for line in lines[line_num:]:
-        if line == '':
-            break
-        line_num += 1
-        line_items = line[1:].split('\t')
-        question_id, text = [item for item in line_items if len(item)>0]
-        text = ' '.join(text.split()) # remove double spaces
-        if question_id not in parsed:
+    previous_question_id = None
+    for line in lines:
+        if skip:
+            skip -= 1
             continue
         
-        # use raw string notation for regular expressions, prevents a lot of escaping backslashes
-        parse_name = re.compile(r'''
-            mentor\s(\S\S.+?)(?:\bheeft\b|\bhas\b|$)|
-            docent\s(\S\S.+?)(?:\bheeft\b|\bmaakt\b|\bgeeft\b|$)|
-            lecturer\s(\S\S.+?)(?:\bhas\b|\bmakes\b|\bgives\b|\bprovides\b|\bis\b|$)''',
-            re.IGNORECASE | re.VERBOSE)
-        name = parse_name.findall(text)
-        if name:
-            name = ''.join(name[0]).strip()
-            if name.startswith('heb'): # for name parsing edge cases
-                name = None
-            else:
-                text = text.replace(name, '%p')
-                parsed[question_id]['person'] = name
-
-        text = re.sub('[^A-Za-z %]', '', text) # remove punctuation after parse_name to retain punctuation in name (except %)
-                
-        parse_session_form = re.compile(r'''
-            (sommen|vaardigheden|(?<![+])practic|mentor)|
-            (skills|(?<![+])tutorial|exercise|mentor)''',
-            re.IGNORECASE | re.VERBOSE)
-        session_form = parse_session_form.findall(text)
-        if session_form:
-            session_form = ''.join(session_form[0]).strip().lower()
-            if session_form == 'sommen' or session_form == 'exercise':
-                session_form = 'exercise lecture'
-            elif session_form == 'vaardigheden' or session_form == 'skills':
-                session_form = 'skills tutorial'
-            elif session_form == 'mentor':
-                session_form = 'guidance'
-            else:
-                session_form = 'tutorial'
-            # replacing the session form in the question text is too complicated for now, implement later
-            parsed[question_id]['session_form'] = session_form
+        if state == 'header':
+            # parse question_ids
+            question_ids = line.split(')')[-1][:-1].strip().split(' ')
+            width = len(question_ids)
+            padding = array('i', [MISSING]) * width
+            answered = 0 # number of leading question_ids with results, short rows are padded with MISSING
+            state = 'results'
+            skip = 1
+        
+        elif state == 'results':
+            if line == 'END DATA.':
+                add_result_columns(questions, question_ids, answered, results)
+                if len(questions) == 0:
+                    break
+                state = 'questions'
+                skip = 3
+                continue
+            row = line.split(',')
+            respondents.append(row[0])
+            question_results = row[1:width + 1]
+            results.extend(map(int, question_results))
+            if len(question_results) < width:
+                results.extend(padding[len(question_results):])
+            answered = max(answered, len(question_results))
         
-        parsed[question_id]['text'] = text
-        parsed[question_id]['question_ordernr'] = question_ordernr
-        parsed[question_id]['type'] = 'mc'
-        question_ordernr += 1
+        elif state == 'questions':
+            # parse questions, incl name, sessionform and question order
+            if line == '':
+                state = 'answer_options'
+                skip = 1
+                continue
+            line_items = line[1:].split('\t')
+            question_id, text = [item for item in line_items if len(item)>0]
+            if question_id not in questions:
+                continue
+            text = ' '.join(text.split()) # remove double spaces
+            text, person, session_form = parse_question_text(text)
+            if person:
+                questions[question_id]['person'] = person
+            if session_form:
+                questions[question_id]['session_form'] = session_form
+            questions[question_id]['text'] = text
+            questions[question_id]['question_ordernr'] = question_ordernr
+            questions[question_id]['type'] = 'mc'
+            question_ordernr += 1
+        
+        else: # state == answer_options
+            line_items = [item for item in line.split('\t') if len(item)>0]
+            if 'VAR' in line_items[0]:
+                question_id, answer_option_id, answer_option_text = line_items
+                if question_id.startswith('/'):
+                    question_id = question_id[1:]
+                previous_question_id = question_id
+            else:
+                question_id = previous_question_id
+                answer_option_id, answer_option_text = line_items
+            if question_id not in questions:
+                continue
+            answer_option_id = int(answer_option_id[1:-1])
+            questions[question_id]['answer_options'][answer_option_id] = answer_option_text[1:-1]
     
-    # parse answer options
-    line_num += 2
-    previous_question_id = None
-    for line in lines[line_num:]:
-        line_items = [item for item in line.split('\t') if len(item)>0]
-        if 'VAR' in line_items[0]:
-            question_id, answer_option_id, answer_option_text = line_items
-            if question_id.startswith('/'):
-                question_id = question_id[1:]
-            previous_question_id = question_id
-        else:
-            question_id = previous_question_id
-            answer_option_id, answer_option_text = line_items
-        if question_id not in parsed:
-            continue
-        answer_option_id = int(answer_option_id[1:-1])
-        parsed[question_id]['answer_options'][answer_option_id] = answer_option_text[1:-1]
+    if question_ids is None:
+        logging.info('File contains no usable data, file skipped')
+        return None
+    if state == 'results': # no END DATA
+        add_result_columns(questions, question_ids, answered, results)
+    if len(questions) == 0:
+        logging.info('File contains no usable results, file skipped')
+        return None
+    return parsed
+
+def index_answer_columns(label_row):
+    # column indexes in the answersheet per question id, the question id is the last word of the column label
+    answer_columns = {}
+    for column_index, column_label in enumerate(label_row):
+        answer_columns.setdefault(column_label.split(' ')[-1], []).append(column_index)
+    return answer_columns
+
+def parse_spss_file(file, language_cache = None, contents = None):
+    # parse SPSS files and return dict parsed
+    # contents holds the bytes of artifacts handed over in memory by the pipeline, other artifacts are read from disk
+    # lines are read one at a time, splitlines keeps the line breaks of reading the whole file at once
+    contents = contents or {}
+    paths = input_paths(file)
+    if 'spss' in contents:
+        spss_file = io.TextIOWrapper(io.BytesIO(contents['spss']), encoding = 'utf-8')
+    else:
+        spss_file = io.open(paths['spss'], encoding = 'utf-8')
+    lap = run_report.stage_timer('parse', file)
+    with spss_file:
+        parsed = parse_spss_syntax(line for file_line in spss_file for line in file_line.splitlines())
+    lap('spss')
+    if parsed is None:
+        return None
     
     # detect language for every mc question, use language with highest count
-    language_collection = Counter()
-    for question_id, content in parsed.items():
-        language = detect(content['text'])
-        language_collection[language] += 1
-    language = language_collection.most_common()[0][0]
-    for question_id, content in parsed.items():
-        parsed[question_id]['language'] = language
+    if language_cache is None:
+        language_cache = load_language_cache(None)
+    questions = parsed['questions']
+    language = detect_file_language([content['text'] for content in questions.values()], language_cache)
+    for question_id, content in questions.items():
+        questions[question_id]['language'] = language
+    lap('language')
     
     # find corresponding definition file and add question definitions to parsed
-    SIN_evaluation_id = file[:-4].split('_')[-1]
     try:
-        definition_file = io.open(os.path.join(DEFINITION_DIR, SIN_evaluation_id + '.txt'), 
-            encoding = 'utf-8').read().splitlines()
+        if 'definitions' in contents:
+            definition_file = contents['definitions'].decode('utf-8').splitlines()
+        else:
+            definition_file = io.open(paths['definitions'], encoding = 'utf-8').read().splitlines()
     except IOError:
         logging.info('FAILURE: no definition file found, file skipped')
         return None
@@ -182,34 +642,34 @@ def parse_spss_file(file):
                 if not char.isdigit():
                     question_id = question_id_tag[:ind]
                     question_tag = question_id_tag[ind:]
-                    parsed['VAR' + question_id]['tag'] = question_tag
+                    questions['VAR' + question_id]['tag'] = question_tag
                     break
+    lap('definitions')
     
     # parse excel files for open answers and add to parsed
+    # sheets are loaded on demand, the answer columns are indexed by question id once per workbook
     try:
-        excelbook = xlrd.open_workbook(os.path.join(EXCEL_DIR, SIN_evaluation_id + '.xls'), 
-            logfile = open(os.path.join(LOGGING_DIR, 'xlrd.log'), 'w'))
+        excelbook = xlrd.open_workbook(paths['xls'], file_contents = contents.get('xls'),
+            logfile = open(os.path.join(LOGGING_DIR, 'xlrd.log'), 'w'), on_demand = True)
     except IOError:
         logging.info('WARNING: no results for open answers available, mc results parsed')
         return parsed
-    questionsheet = excelbook.sheet_by_index(2)
-    rows = questionsheet.get_rows()
-    question_ordernr = -1 # to account for the header row in the questionsheet
-    for question_id, question_text, question_type in rows:
-        question_ordernr += 1
-        if question_type.value == 'OPEN':
-            question_id = str(question_id.value)[:-2] # slice to get rid of the decimal .0
-            answersheet = excelbook.sheet_by_index(1)
-            label_row = answersheet.row_values(rowx = 0)
-            for column_index, column_label in enumerate(label_row):
-                column_label = column_label.split(' ')[-1]
-                if column_label == question_id:
-                    answerrows = answersheet.get_rows()
-                    next(answerrows)
-                    for row in answerrows:
-                        result = row[column_index].value
+    try:
+        questionsheet = excelbook.sheet_by_index(2)
+        answersheet = excelbook.sheet_by_index(1)
+        answer_columns = index_answer_columns(answersheet.row_values(rowx = 0))
+        respondent_ids = answersheet.col_values(0, start_rowx = 1)
+        rows = questionsheet.get_rows()
+        question_ordernr = -1 # to account for the header row in the questionsheet
+        for question_id, question_text, question_type in rows:
+            question_ordernr += 1
+            if question_type.value == 'OPEN':
+                question_id = str(question_id.value)[:-2] # slice to get rid of the decimal .0
+                for column_index in answer_columns.get(question_id, []):
+                    answers = answersheet.col_values(column_index, start_rowx = 1)
+                    for respondent_id, result in izip(respondent_ids, answers):
                         if result:
-                            parsed.setdefault(question_id, {
+                            questions.setdefault(question_id, {
                             'text' : question_text.value,
                             'tag' : NA_VALUE,
                             'language' : language,
@@ -219,15 +679,26 @@ def parse_spss_file(file):
                             'type' : 'open',
                             'db_question_id' : NA_VALUE,
                             'answer_options' : NA_VALUE,
-                            'results' : {}
-                            })['results'][row[0].value] = row[column_index].value
+                            'results' : {} # open answers per respondent id of the excel file
+                            })['results'][respondent_id] = result
+    finally:
+        excelbook.release_resources()
+    lap('excel')
 
     # write parsed file for debugging purposes
-    write_json_file(parsed, os.path.join(os.getcwd(), 'debug_files', 'parsed_file_' + file))
+    if WRITE_DEBUG_FILES:
+        write_json_file(parsed, os.path.join(os.getcwd(), 'debug_files', 'parsed_file_' + file))
 
     return parsed
 
-def insert_data(file, parsed, connection, tables):
+def insert_rows(connection, table, rows, batch_size):
+    # multi-row insert (executemany) in batches of batch_size rows
+    for start in range(0, len(rows), batch_size):
+        connection.execute(table.insert(), rows[start:start + batch_size])
+
+def insert_data(file, parsed, connection, tables, question_index, batch_size = BATCH_SIZE):
+    # insert parsed file, return the key of the new evaluation or None on import errors
+    lap = run_report.stage_timer('import', file)
     # insert evaluation
     code, year, SIN_evaluation_name, SIN_evaluation_id = file[:-4].split('_', 3)
     year = int('20' + year)
@@ -238,12 +709,11 @@ def insert_data(file, parsed, connection, tables):
     else:
         logging.info('IMPORT ERROR: block not listed in filename')
         return None
-    sql_select = select([tables['table_evaluation']])
-    result = connection.execute(sql_select)
-    for item in result:
-        if item['EVL_SIN_ID'] == SIN_evaluation_id:
-            logging.info('IMPORT ERROR: file already imported')
-            return None
+    sql_select = select([list(tables['table_evaluation'].primary_key.columns)[0]]).where(
+                         tables['table_evaluation'].c.EVL_SIN_ID == SIN_evaluation_id).limit(1)
+    if connection.execute(sql_select).first() is not None:
+        logging.info('IMPORT ERROR: file already imported')
+        return None
     ins = connection.execute(
         tables['table_evaluation'].insert().values({
         'EVL_JAAR' : year,
@@ -255,37 +725,20 @@ def insert_data(file, parsed, connection, tables):
         )
     key_evaluation = ins.inserted_primary_key[0]
     logging.debug('Inserted evaluation')
+    lap('evaluation')
     
-    # insert questions, mc_answer_options and open_answer_options
-    for question_id, content in parsed.items():
+    # insert questions one by one for their keys, collect mc_answer_options and open_answer_options
+    mc_answer_option_rows = []
+    open_answer_option_rows = []
+    questions = parsed['questions']
+    for question_id, content in questions.items():
         if content['type'] == 'mc':
-            parsed_question_ao = {}
-            for answer_option_id, answer_option_text in content['answer_options'].items():
-                parsed_question_ao.setdefault(content['text'], {})[answer_option_id] = answer_option_text
-            sql_select = select([tables['table_questions'], 
-                                 tables['table_mc_answer_options']]).where(
-                                 tables['table_questions'].c.VRG_ID == 
-                                 tables['table_mc_answer_options'].c.AMC_VRAAG)
-            result = connection.execute(sql_select)
-            db_question_data = {}
-            for row in result:
-                db_question_data.setdefault(
-                    row['VRG_ID'],
-                    {}).setdefault(row['VRG_TEXT'],
-                    {})[row['AMC_ORDERID']] = row['AMC_TEXT']
-            for db_question_id, db_question_ao in db_question_data.items():
-                if db_question_ao == parsed_question_ao:
-                    parsed[question_id]['db_question_id'] = db_question_id
-                    break
+            if content['answer_options']: # questions without answer options never match
+                key = mc_question_key(content['text'], content['answer_options'])
+                questions[question_id]['db_question_id'] = question_index['mc'].get(key)
         else: # type == open
-            parsed_question = content['text']
-            sql_select = select([tables['table_questions']])
-            result = connection.execute(sql_select)
-            for row in result:
-                if row['VRG_TEXT'] == parsed_question:
-                    parsed[question_id]['db_question_id'] = row['VRG_ID']
-                    break
-        if parsed.get(question_id).get('db_question_id') == None:
+            questions[question_id]['db_question_id'] = question_index['open'].get(content['text'])
+        if questions.get(question_id).get('db_question_id') == None:
             ins = connection.execute(tables['table_questions'].insert().values({
                 'VRG_TEXT' : content['text'],
                 'VRG_TAG' : content['tag'],
@@ -297,29 +750,32 @@ def insert_data(file, parsed, connection, tables):
                 })
                 )
             key_question = ins.inserted_primary_key[0]
-            parsed[question_id]['db_question_id'] = key_question
+            questions[question_id]['db_question_id'] = key_question
+            add_to_question_index(question_index, content, key_question)
             if content['type'] == 'mc':
                 for answer_option_id, answer_option_text in content['answer_options'].items():
-                    connection.execute(tables['table_mc_answer_options'].insert().values({
+                    mc_answer_option_rows.append({
                         'AMC_VRAAG' : key_question,
                         'AMC_TEXT' : answer_option_text,
                         'AMC_ORDERID' : answer_option_id,
                         'AMC_FAC' : FAC
                         })
-                        )
             else:
-                connection.execute(tables['table_open_answer_options'].insert().values({
+                open_answer_option_rows.append({
                     'AOP_VRAAG' : key_question,
                     'AOP_FAC' : FAC
                     })
-                    )
-                
-        
+    insert_rows(connection, tables['table_mc_answer_options'], mc_answer_option_rows, batch_size)
+    insert_rows(connection, tables['table_open_answer_options'], open_answer_option_rows, batch_size)
     logging.debug('Inserted questions & answer options')
+    lap('question_matching')
     
-    # insert evaluation_questions, mc_results and open results
-    for question_id, content in parsed.items():
-        ins = connection.execute(tables['table_evaluation_questions'].insert().values({
+    # insert evaluation_questions, keys are read back in insertion order
+    question_ids = questions.keys()
+    evaluation_question_rows = []
+    for question_id in question_ids:
+        content = questions[question_id]
+        evaluation_question_rows.append({
         'EEV_EVALUATIE' : key_evaluation,
         'EEV_VRAAG' : content['db_question_id'],
         'EEV_PARAM_DOCENT_NAAM' : content['person'],
@@ -328,74 +784,226 @@ def insert_data(file, parsed, connection, tables):
         'EEV_ORDERID' : content['question_ordernr'],
         'EEV_FAC' : FAC
         })
-        )
-        key_evaluation_questions = ins.inserted_primary_key[0]
-        parsed[question_id]['evaluation_question_id'] = key_evaluation_questions
+    insert_rows(connection, tables['table_evaluation_questions'], evaluation_question_rows, batch_size)
+    table_evaluation_questions = tables['table_evaluation_questions']
+    primary_key = list(table_evaluation_questions.primary_key.columns)[0]
+    sql_select = select([primary_key]).where(
+                        table_evaluation_questions.c.EEV_EVALUATIE == key_evaluation).order_by(primary_key)
+    keys_evaluation_questions = [row[0] for row in connection.execute(sql_select)]
+    for question_id, key_evaluation_questions in zip(question_ids, keys_evaluation_questions):
+        questions[question_id]['evaluation_question_id'] = key_evaluation_questions
+    lap('evaluation_questions')
     
-        for respondent_id, result in content['results'].items():
-            if result == -1:
+    # insert mc_results and open results in batches
+    mc_result_rows = []
+    open_result_rows = []
+    for question_id, content in questions.items():
+        key_evaluation_questions = content['evaluation_question_id']
+        if content['type'] == 'mc': # results array has one answer per respondent in parsed['respondents']
+            results = izip(parsed['respondents'], content['results'])
+        else: # open answers per respondent id of the excel file
+            results = content['results'].iteritems()
+        for respondent_id, result in results:
+            if result == MISSING:
                 continue
             if content['type'] == 'mc':
-                connection.execute(tables['table_mc_results'].insert().values({
+                mc_result_rows.append({
                 'RMC_STUDENT' : respondent_id,
                 'RMC_ANTWOORD_SUBID' : result,
                 'RMC_ANTWOORD_ID' : content['db_question_id'],
                 'RMC_VRAAG' : key_evaluation_questions,
                 'RMC_FAC' : FAC
                 })
-                )
             else: # type == open
-                connection.execute(tables['table_open_results'].insert().values({
+                open_result_rows.append({
                     'ROP_STUDENT' : respondent_id,
                     'ROP_CONTENT' : result,
                     'ROP_ANTWOORD_ID' : content['db_question_id'],
                     'ROP_VRAAG' : key_evaluation_questions,
                     'ROP_FAC' : FAC
                     })
-                    )
-            
+            if len(mc_result_rows) >= batch_size:
+                insert_rows(connection, tables['table_mc_results'], mc_result_rows, batch_size)
+                mc_result_rows = []
+            if len(open_result_rows) >= batch_size:
+                insert_rows(connection, tables['table_open_results'], open_result_rows, batch_size)
+                open_result_rows = []
+    insert_rows(connection, tables['table_mc_results'], mc_result_rows, batch_size)
+    insert_rows(connection, tables['table_open_results'], open_result_rows, batch_size)
     logging.debug('Inserted evaluation_questions & results')
+    lap('results')
 
     # write keyed file for debugging purposes
-    write_json_file(parsed, os.path.join(os.getcwd(), 'debug_files', 'keyed_file_' + file)) 
+    if WRITE_DEBUG_FILES:
+        write_json_file(parsed, os.path.join(os.getcwd(), 'debug_files', 'keyed_file_' + file)) 
     
-    return True
+    return key_evaluation
+
+class ListHandler(logging.Handler):
+    # collects log records of a parse process, the main process logs them in file order
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+def init_parse_worker(language_cache, write_debug_files, report_settings = (False, None)):
+    # runs once in every parse process: replace the handlers inherited from the main process
+    # and keep a copy of the language cache and the settings
+    global WORKER_LANGUAGE_CACHE, WRITE_DEBUG_FILES
+    WORKER_LANGUAGE_CACHE = language_cache
+    WRITE_DEBUG_FILES = write_debug_files
+    run_report.configure(*report_settings)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(ListHandler())
+    root.setLevel(logging.INFO)
+
+def parse_file_worker(task):
+    # parse one file in a parse process, task is file and the contents handed over in memory (or None)
+    # return file, parsed, the collected log records, the language cache lookups and the timings for the main process
+    file, contents = task
+    handler = logging.getLogger().handlers[0]
+    handler.records = []
+    parsed = run_report.profiled(file, parse_spss_file, file, WORKER_LANGUAGE_CACHE, contents)
+    used = WORKER_LANGUAGE_CACHE['used']
+    WORKER_LANGUAGE_CACHE['used'] = {}
+    merge_language_cache(WORKER_LANGUAGE_CACHE, used)
+    return file, parsed, handler.records, used, run_report.take_timings()
+
+def parse_file_serial(task, language_cache):
+    # parse one file in the main process, log records and timings are written directly
+    file, contents = task
+    parsed = run_report.profiled(file, parse_spss_file, file, language_cache, contents)
+    used = language_cache['used']
+    language_cache['used'] = {}
+    return file, parsed, [], used, []
 
 def main():
+    parser = argparse.ArgumentParser(description = 'Parse downloaded course evaluations and import them in the database')
+    parser.add_argument('--db', default = DB_URL, help = 'database url (default: %(default)s)')
+    parser.add_argument('--create-db', action = 'store_true',
+        help = 'create missing tables and indexes in the database and exit')
+    parser.add_argument('--reflect', action = 'store_true',
+        help = 'load the schema from the database instead of the schema defined in this script')
+    parser.add_argument('--batch-size', type = int, default = BATCH_SIZE,
+        help = 'rows per multi-row insert (default: %(default)s)')
+    parser.add_argument('--files-per-transaction', type = int, default = FILES_PER_TRANSACTION,
+        help = 'files imported per transaction, with a savepoint per file so failed files are still '
+               'rolled back on their own (default: %(default)s)')
+    parser.add_argument('--journal-mode', choices = SQLITE_JOURNAL_MODES,
+        help = 'sqlite journal mode, e.g. wal (default: sqlite default)')
+    parser.add_argument('--synchronous', choices = SQLITE_SYNCHRONOUS,
+        help = 'sqlite synchronous level, e.g. normal (default: sqlite default)')
+    parser.add_argument('--cache-size', type = int,
+        help = 'sqlite page cache, in pages or in KiB when negative (default: sqlite default)')
+    parser.add_argument('-w', '--workers', type = int, default = WORKERS,
+        help = 'number of parse processes, 1 parses in the main process (default: %(default)s)')
+    parser.add_argument('--language-cache', default = LANGUAGE_CACHE_FILE,
+        help = 'file with cached question languages (default: %(default)s)')
+    parser.add_argument('--language-cache-size', type = int, default = LANGUAGE_CACHE_SIZE,
+        help = 'max number of question texts in the language cache (default: %(default)s)')
+    parser.add_argument('--debug-files', action = 'store_true',
+        help = 'write parsed and keyed files as json to debug_files')
+    parser.add_argument('--reimport', action = 'store_true',
+        help = 'import all files again, also files unchanged since their last import')
+    parser.add_argument('--report',
+        help = 'write per-file, per-stage timings to this file, csv for a .csv file, json otherwise')
+    parser.add_argument('--profile',
+        help = 'profile parsing and import of the files whose name contains this text, stats in logs/profile_*.prof')
+    args = parser.parse_args()
+    global WRITE_DEBUG_FILES
+    WRITE_DEBUG_FILES = args.debug_files
+    run_report.configure(bool(args.report), args.profile)
+
+    db = create_db_engine(args.db, args.journal_mode, args.synchronous, args.cache_size)
+    if args.create_db:
+        create_db(db, define_db())
+        return
+    # log file is set up here, so parse processes and other scripts importing this module don't create one
+    logging.basicConfig(filename = os.path.join(os.getcwd(), 
+                            LOGGING_DIR, 'parse_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'), 
+                            level = logging.INFO,
+                            format = '%(asctime)s: %(message)s', datefmt = '%Y_%m_%d_%H:%M:%S')
     logging.info('Start log')
     start_time = datetime.now()
-    db = create_engine('sqlite:///test_evaldb.db', echo = False)
-    tables = reflect_db(db)
+    if args.reflect:
+        tables = reflect_db(db)
+    else:
+        tables = define_db()
+        # stop before importing anything when the database was not created with define_db
+        differences = schema_differences(db, tables)
+        if differences:
+            print 'Database does not match the schema in define_db:'
+            for difference in differences:
+                print '  ' + difference
+            print 'Use --reflect to load the schema from the database, or --create-db for a new database'
+            logging.info('Database does not match the schema in define_db (%s), script terminated', '; '.join(differences))
+            exit()
+    tables['table_import_ledger'].create(db, checkfirst = True)
     connection = db.connect()
-    files = os.listdir(SPSS_DIR)
-    total_files = len(files)
-    file_counter = 0
+    question_index = load_question_index(connection, tables)
+    files = [file for file in os.listdir(SPSS_DIR) if not file.endswith('.part')] # skip unfinished downloads
     print 'Check filenames for block info...'
     for file in files:
         if file.find('block') == -1 and file.find('blok') == -1:
             print 'Filename(s) without block info found, please add block info to filename(s)'
             logging.info('Filename(s) without block info found, script terminated')
             exit()
-    for file in files:
+    # skip files imported before with the same SPSS, definition and excel content, before parsing them
+    ledger = load_import_ledger(connection, tables)
+    hashes = {}
+    skipped_files = 0
+    transaction = connection.begin()
+    for file in files[:]:
+        with run_report.timed('parse', file, 'hashes'):
+            hashes[file] = import_hashes(file)
+        status = check_import_ledger(ledger, file, hashes[file], args.reimport)
+        if status in SKIP_STATUS:
+            skip_file(connection, tables, ledger, file, hashes[file], status)
+            files.remove(file)
+            skipped_files += 1
+    transaction.commit()
+    print 'Skipped', skipped_files, 'file(s) unchanged since last import'
+    total_files = len(files)
+    file_counter = 0
+    # files are parsed ahead in parse processes, results come back in file order for the single db writer
+    language_cache = load_language_cache(args.language_cache, args.language_cache_size)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, init_parse_worker,
+            (language_cache, args.debug_files, run_report.settings()))
+        parsed_files = pool.imap(parse_file_worker, ((file, None) for file in files))
+    else:
+        pool = None
+        parsed_files = (parse_file_serial((file, None), language_cache) for file in files)
+    # with --files-per-transaction > 1 files are imported in an outer transaction, committed every n files
+    files_per_transaction = max(args.files_per_transaction, 1)
+    transaction = None
+    for file, parsed, log_records, used_languages, timings in parsed_files:
+        merge_language_cache(language_cache, used_languages)
+        run_report.merge_timings(timings)
         file_counter += 1
         print 'Processing:', file, '(%s of %s)' %(file_counter, total_files)
-        logging.info('Importing file \'%s\'', file)
-        parsed = parse_spss_file(file)
+        if files_per_transaction > 1 and transaction is None:
+            transaction = connection.begin()
         # parsed = None # for debugging: enable parsing only, create a CLI switch for this
-        if not parsed:
-            continue
-        logging.debug('File parsed')
-        transaction = connection.begin()
-        success = insert_data(file, parsed, connection, tables)
-        if success:
-            # transaction.rollback() # for debugging, rollback after every succesfull entry
+        run_report.profiled('import_' + file, import_file, file, parsed, log_records, connection, tables,
+            question_index, ledger, hashes[file], max(args.batch_size, 1))
+        if transaction is not None and (file_counter % files_per_transaction == 0 or file_counter == total_files):
             transaction.commit()
-            logging.info('SUCCES: file imported')
-        else:
-            transaction.rollback()
-            logging.info('FAILURE: import error, file not imported')
+            commit_question_index(question_index)
+            logging.info('Transaction committed')
+            transaction = None
+    if pool:
+        pool.close()
+        pool.join()
+    save_language_cache(language_cache)
     end_time = datetime.now()
     print 'Elapsed time:', str(end_time - start_time).split('.')[0]
+    if args.report:
+        run_report.write_report(args.report, 'parse_results', (end_time - start_time).total_seconds())
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
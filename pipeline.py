@@ -0,0 +1,200 @@
+# download, parse and import course evaluations in one run
+# an evaluation goes to the parse processes as soon as its files are downloaded and is then imported
+# by a single db writer, so downloading and parsing overlap instead of running one after the other
+# usage: python pipeline.py inputfile [-w 4] [-p 4] [--in-memory] [--base-url http://localhost:8000]
+#   inputfile as for download_results.py, files are saved as by download_results.py
+import os # os interactions, from std library
+import logging # logging, from std library
+import argparse # command line arguments, from std library
+import threading # download thread, from std library
+import multiprocessing # to parse files in parallel processes, from std library
+import Queue # bounded queue from download to parse, from std library
+from multiprocessing.dummy import Pool as ThreadPool # pool of worker threads, from std library
+from datetime import datetime, timedelta # for dates + times, from std. library
+
+import download_results
+import parse_results
+import run_report # per-stage timings and profiling
+
+# globals
+QUEUE_SIZE = 16 # downloaded evaluations waiting for parsing, downloads wait when the queue is full
+
+# functions
+def download_courses(filenames, downloader, downloaded, workers):
+    # download all courses, downloader['on_evaluation'] puts every downloaded evaluation in queue downloaded
+    # None marks the end of the downloads, also when a download fails
+    try:
+        course_pool = ThreadPool(workers)
+        course_pool.map(lambda filename: download_results.download_course(filename, downloader), filenames)
+        course_pool.close()
+    finally:
+        downloaded.put(None)
+
+def evaluation_tasks(downloaded, in_flight, ledger, reimport):
+    # parse tasks for downloaded evaluations up to the end of the downloads
+    # in_flight limits the evaluations between queue and db writer, released by the db writer after every evaluation
+    # files with a SKIP_STATUS in the import ledger go through without their contents and are not parsed
+    while True:
+        in_flight.acquire()
+        item = downloaded.get()
+        if item is None:
+            return
+        file, contents = item
+        with run_report.timed('parse', file, 'hashes'):
+            hashes = parse_results.import_hashes(file, contents)
+        status = parse_results.check_import_ledger(ledger, file, hashes, reimport)
+        if status in parse_results.SKIP_STATUS:
+            contents = None
+        yield status, hashes, file, contents
+
+def parse_evaluation(task):
+    # parse one downloaded evaluation in a parse process
+    # return import ledger status and hashes, followed by the result of parse_results.parse_file_worker
+    status, hashes, file, contents = task
+    if status in parse_results.SKIP_STATUS:
+        return (status, hashes, file, None, [], {}, [])
+    return (status, hashes) + parse_results.parse_file_worker((file, contents))
+
+def parse_evaluation_serial(task, language_cache):
+    # parse one downloaded evaluation in the main process
+    status, hashes, file, contents = task
+    if status in parse_results.SKIP_STATUS:
+        return (status, hashes, file, None, [], {}, [])
+    return (status, hashes) + parse_results.parse_file_serial((file, contents), language_cache)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Download, parse and import course evaluations in one run')
+    parser.add_argument('inputfile', help = 'file with one course per line, format: VAKACODE-YEAR')
+    parser.add_argument('-w', '--workers', type = int, default = download_results.WORKERS,
+        help = 'number of concurrent downloads (default: %(default)s)')
+    parser.add_argument('-p', '--parse-workers', type = int, default = parse_results.WORKERS,
+        help = 'number of parse processes, 1 parses in the main process (default: %(default)s)')
+    parser.add_argument('--queue-size', type = int, default = QUEUE_SIZE,
+        help = 'max number of downloaded evaluations waiting for parsing (default: %(default)s)')
+    parser.add_argument('--in-memory', action = 'store_true',
+        help = 'hand downloaded files to the parse processes in memory instead of reading them from disk again')
+    parser.add_argument('--base-url',
+        help = 'download from this server instead of SIN-online, e.g. a local stand-in server')
+    parser.add_argument('--db', default = parse_results.DB_URL, help = 'database url (default: %(default)s)')
+    parser.add_argument('--batch-size', type = int, default = parse_results.BATCH_SIZE,
+        help = 'rows per multi-row insert (default: %(default)s)')
+    parser.add_argument('--journal-mode', choices = parse_results.SQLITE_JOURNAL_MODES,
+        help = 'sqlite journal mode, e.g. wal (default: sqlite default)')
+    parser.add_argument('--synchronous', choices = parse_results.SQLITE_SYNCHRONOUS,
+        help = 'sqlite synchronous level, e.g. normal (default: sqlite default)')
+    parser.add_argument('--cache-size', type = int,
+        help = 'sqlite page cache, in pages or in KiB when negative (default: sqlite default)')
+    parser.add_argument('--manifest', default = download_results.MANIFEST_FILE,
+        help = 'manifest of downloaded files, used to skip files on re-runs (default: %(default)s)')
+    parser.add_argument('--verify', action = 'store_true',
+        help = 'compare content hash of downloaded files with the manifest, not only the size')
+    parser.add_argument('--discovery-cache', default = download_results.DISCOVERY_CACHE_FILE,
+        help = 'cache of channel and evaluation ids per course (default: %(default)s)')
+    parser.add_argument('--cache-ttl', type = float,
+        help = 'days after which cached channel and evaluation ids are looked up again (default: never)')
+    parser.add_argument('--language-cache', default = parse_results.LANGUAGE_CACHE_FILE,
+        help = 'file with cached question languages (default: %(default)s)')
+    parser.add_argument('--language-cache-size', type = int, default = parse_results.LANGUAGE_CACHE_SIZE,
+        help = 'max number of question texts in the language cache (default: %(default)s)')
+    parser.add_argument('--reimport', action = 'store_true',
+        help = 'import all evaluations again, also evaluations unchanged since their last import')
+    parser.add_argument('--report',
+        help = 'write per-file, per-stage timings to this file, csv for a .csv file, json otherwise')
+    parser.add_argument('--profile',
+        help = 'profile the courses and files whose name contains this text, stats in logs/profile_*.prof')
+    args = parser.parse_args()
+    run_report.configure(bool(args.report), args.profile)
+    workers = max(args.workers, 1)
+    queue_size = max(args.queue_size, 1)
+    if args.base_url:
+        download_results.SIN_HTTP_URL = download_results.SIN_HTTPS_URL = args.base_url.rstrip('/')
+
+    logging.basicConfig(filename = os.path.join(os.getcwd(),
+                            parse_results.LOGGING_DIR, 'pipeline_' + datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'),
+                            level = logging.INFO,
+                            format = '%(asctime)s: %(message)s', datefmt = '%Y_%m_%d_%H:%M:%S')
+    logging.info('Start log')
+    start_time = datetime.now()
+
+    # db writer state, as in parse_results
+    db = parse_results.create_db_engine(args.db, args.journal_mode, args.synchronous, args.cache_size)
+    tables = parse_results.define_db()
+    differences = parse_results.schema_differences(db, tables)
+    if differences:
+        print 'Database does not match the schema in define_db:'
+        for difference in differences:
+            print '  ' + difference
+        print 'Import this database with parse_results.py --reflect, or create a new one with parse_results.py --create-db'
+        logging.info('Database does not match the schema in define_db (%s), script terminated', '; '.join(differences))
+        return
+    tables['table_import_ledger'].create(db, checkfirst = True)
+    connection = db.connect()
+    question_index = parse_results.load_question_index(connection, tables)
+    ledger = parse_results.load_import_ledger(connection, tables)
+    language_cache = parse_results.load_language_cache(args.language_cache, args.language_cache_size)
+    # parse processes are started before the download threads
+    if args.parse_workers > 1:
+        pool = multiprocessing.Pool(args.parse_workers, parse_results.init_parse_worker,
+            (language_cache, False, run_report.settings()))
+    else:
+        pool = None
+
+    # downloads run in a background thread and hand every downloaded evaluation over through the queue
+    ttl = timedelta(days = args.cache_ttl) if args.cache_ttl is not None else None
+    sess = download_results.sin_login(workers)
+    with open(args.inputfile) as files:
+        filenames = [filename.rstrip() for filename in files if filename.strip()]
+    downloaded = Queue.Queue(queue_size)
+    downloader = {
+        'sess' : sess,
+        'evaluation_pool' : ThreadPool(workers),
+        'manifest' : download_results.load_manifest(args.manifest, args.verify),
+        'discovery_cache' : download_results.load_discovery_cache(args.discovery_cache, ttl),
+        'keep_contents' : args.in_memory,
+        'on_evaluation' : lambda file, contents: downloaded.put((file, contents))
+        }
+    download_thread = threading.Thread(target = download_courses, args = (filenames, downloader, downloaded, workers))
+    download_thread.daemon = True
+    download_thread.start()
+
+    # parse as the evaluations come in, import in arrival order
+    in_flight = threading.Semaphore(queue_size)
+    tasks = evaluation_tasks(downloaded, in_flight, ledger, args.reimport)
+    if pool:
+        parsed_files = pool.imap(parse_evaluation, tasks)
+    else:
+        parsed_files = (parse_evaluation_serial(task, language_cache) for task in tasks)
+    counts = {'imported' : 0, 'skipped' : 0, 'failed' : 0}
+    for status, hashes, file, parsed, log_records, used_languages, timings in parsed_files:
+        parse_results.merge_language_cache(language_cache, used_languages)
+        run_report.merge_timings(timings)
+        if status in parse_results.SKIP_STATUS:
+            transaction = connection.begin()
+            parse_results.skip_file(connection, tables, ledger, file, hashes, status)
+            transaction.commit()
+            counts['skipped'] += 1
+        elif run_report.profiled('import_' + file, parse_results.import_file, file, parsed, log_records, connection,
+                tables, question_index, ledger, hashes, max(args.batch_size, 1)):
+            if counts['imported'] == 0:
+                first_import = str(datetime.now() - start_time).split('.')[0]
+                logging.info('First evaluation imported after %s', first_import)
+            counts['imported'] += 1
+            with download_results.PRINT_LOCK:
+                print 'Imported:', file
+        else:
+            counts['failed'] += 1
+        in_flight.release()
+    download_thread.join()
+    downloader['evaluation_pool'].close()
+    if pool:
+        pool.close()
+        pool.join()
+    parse_results.save_language_cache(language_cache)
+    end_time = datetime.now()
+    print 'Imported: %(imported)s, skipped (unchanged): %(skipped)s, not imported: %(failed)s' % counts
+    print 'Elapsed time:', str(end_time - start_time).split('.')[0]
+    if args.report:
+        run_report.write_report(args.report, 'pipeline', (end_time - start_time).total_seconds())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# cached read api over the imported evaluations: course history, lecturer scores and question trend
+# usage as library:
+#   api = results_api.open_api('sqlite:///test_evaldb.db')
+#   results_api.course_history(api, 'FEM10000'), results_api.lecturer_scores(api, 'Jansen'),
+#   results_api.question_trend(api, 12)
+# usage as local json server: python results_api.py serve [--port 8001] [--db sqlite:///test_evaldb.db]
+#   GET /course/<EVL_VAK>, /lecturer/<EEV_PARAM_DOCENT_NAAM>, /question/<VRG_ID>, /stats
+# usage from the command line: python results_api.py course FEM10000 (or lecturer NAME, question ID)
+# answers are kept in a least recently used cache, shared by all threads
+# the cache is emptied when the database changed since the last lookup, e.g. after an import by parse_results.py:
+# for sqlite PRAGMA data_version, for other databases the ids in the import ledger
+import json # to import / export json, from std library
+import math # for standard deviations, from std library
+import sqlite3 # data_version of sqlite databases, from std library
+import argparse # command line arguments, from std library
+import threading # lock for the cache, from std library
+from collections import OrderedDict # from std library
+from urllib import unquote # from std library
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # from std library
+from SocketServer import ThreadingMixIn # from std library
+
+from sqlalchemy import select, func, and_ # for sql expressions
+
+import parse_results
+
+# globals
+CACHE_SIZE = 1000 # max number of cached answers
+PORT = 8001
+
+# functions
+def open_api(url = parse_results.DB_URL, cache_size = CACHE_SIZE, reflect = True):
+    # api state: engine, tables, cache and the database version the cache belongs to
+    db = parse_results.create_db_engine(url)
+    api = {
+        'db' : db,
+        'tables' : parse_results.reflect_db(db) if reflect else parse_results.define_db(),
+        'size' : cache_size,
+        'cache' : OrderedDict(),
+        'lock' : threading.Lock(),
+        'version' : None,
+        'version_connection' : None,
+        'hits' : 0,
+        'misses' : 0
+        }
+    if db.dialect.name == 'sqlite' and db.url.database not in (None, '', ':memory:'):
+        # data_version changes when another connection commits, this connection only reads it
+        api['version_connection'] = sqlite3.connect(db.url.database, check_same_thread = False)
+    api['version'] = database_version(api)
+    return api
+
+def database_version(api):
+    # value that changes with every commit to the database, call with api['lock'] held
+    if api['version_connection'] is not None:
+        return api['version_connection'].execute('PRAGMA data_version').fetchone()[0]
+    table_import_ledger = api['tables']['table_import_ledger']
+    with api['db'].connect() as connection:
+        return tuple(connection.execute(select([
+            func.max(table_import_ledger.c.IMP_ID), func.count(table_import_ledger.c.IMP_ID)])).fetchone())
+
+def cached(api, key, query, *args):
+    # answer of query(connection, tables, *args) from the cache, queried and cached when missing
+    # answers are shared between callers and must not be changed
+    with api['lock']:
+        version = database_version(api)
+        if version != api['version']:
+            api['cache'].clear()
+            api['version'] = version
+        cache = api['cache']
+        if key in cache:
+            answer = cache.pop(key)
+            cache[key] = answer # most recently used
+            api['hits'] += 1
+            return answer
+        api['misses'] += 1
+    with api['db'].connect() as connection:
+        answer = query(connection, api['tables'], *args)
+    with api['lock']:
+        # an answer queried during an import is not cached, it may miss part of the import
+        if database_version(api) == version == api['version']:
+            cache[key] = answer
+            while len(cache) > api['size']:
+                cache.popitem(last = False)
+    return answer
+
+def cache_stats(api):
+    with api['lock']:
+        return {'size' : len(api['cache']), 'max_size' : api['size'], 'hits' : api['hits'], 'misses' : api['misses']}
+
+def results_join(tables):
+    # mc results with their evaluation question, evaluation and question
+    table_mc_results = tables['table_mc_results']
+    table_evaluation_questions = tables['table_evaluation_questions']
+    return (table_mc_results
+        .join(table_evaluation_questions, table_mc_results.c.RMC_VRAAG == table_evaluation_questions.c.EEV_ID)
+        .join(tables['table_evaluation'], table_evaluation_questions.c.EEV_EVALUATIE == tables['table_evaluation'].c.EVL_ID)
+        .join(tables['table_questions'], table_evaluation_questions.c.EEV_VRAAG == tables['table_questions'].c.VRG_ID))
+
+def score_rows(connection, tables, columns, condition):
+    # count, mean and standard deviation of the mc answers per group of columns where condition holds
+    # columns: [(name, column)], answers without value (MISSING) are not imported
+    answer = tables['table_mc_results'].c.RMC_ANTWOORD_SUBID
+    group_columns = [column for name, column in columns]
+    query = (select(group_columns + [func.count(answer), func.avg(answer), func.avg(answer * answer)])
+        .select_from(results_join(tables))
+        .where(condition)
+        .group_by(*group_columns)
+        .order_by(*group_columns))
+    rows = []
+    for row in connection.execute(query):
+        values = list(row)
+        count, mean, mean_square = values[-3:]
+        entry = OrderedDict((name, value) for (name, column), value in zip(columns, values))
+        entry['count'] = count
+        entry['mean'] = round(float(mean), 4)
+        entry['std'] = round(math.sqrt(max(float(mean_square) - float(mean) ** 2, 0.0)), 4)
+        rows.append(entry)
+    return rows
+
+def query_course_history(connection, tables, course):
+    table_evaluation = tables['table_evaluation']
+    table_evaluation_questions = tables['table_evaluation_questions']
+    table_questions = tables['table_questions']
+    return score_rows(connection, tables, [
+        ('year', table_evaluation.c.EVL_JAAR),
+        ('period', table_evaluation.c.EVL_PERIODE),
+        ('evaluation', table_evaluation.c.EVL_SIN_ID),
+        ('question', table_questions.c.VRG_ID),
+        ('question_text', table_questions.c.VRG_TEXT),
+        ('lecturer', table_evaluation_questions.c.EEV_PARAM_DOCENT_NAAM),
+        ('session_form', table_evaluation_questions.c.EEV_PARAM_SESSIE)
+        ], table_evaluation.c.EVL_VAK == course)
+
+def query_lecturer_scores(connection, tables, lecturer):
+    table_evaluation = tables['table_evaluation']
+    table_evaluation_questions = tables['table_evaluation_questions']
+    table_questions = tables['table_questions']
+    return score_rows(connection, tables, [
+        ('year', table_evaluation.c.EVL_JAAR),
+        ('period', table_evaluation.c.EVL_PERIODE),
+        ('course', table_evaluation.c.EVL_VAK),
+        ('question', table_questions.c.VRG_ID),
+        ('question_text', table_questions.c.VRG_TEXT),
+        ('session_form', table_evaluation_questions.c.EEV_PARAM_SESSIE)
+        ], table_evaluation_questions.c.EEV_PARAM_DOCENT_NAAM == lecturer)
+
+def query_question_trend(connection, tables, question, course = None):
+    table_evaluation = tables['table_evaluation']
+    condition = tables['table_questions'].c.VRG_ID == question
+    if course is not None:
+        condition = and_(condition, table_evaluation.c.EVL_VAK == course)
+    return score_rows(connection, tables, [
+        ('year', table_evaluation.c.EVL_JAAR),
+        ('period', table_evaluation.c.EVL_PERIODE)
+        ], condition)
+
+def course_history(api, course):
+    # scores per year, period, evaluation, question, lecturer and session form of course (EVL_VAK)
+    return cached(api, ('course', course), query_course_history, course)
+
+def lecturer_scores(api, lecturer):
+    # scores per year, period, course, question and session form of lecturer (EEV_PARAM_DOCENT_NAAM)
+    return cached(api, ('lecturer', lecturer), query_lecturer_scores, lecturer)
+
+def question_trend(api, question, course = None):
+    # scores per year and period of question (VRG_ID), of all courses or of course only
+    return cached(api, ('question', question, course), query_question_trend, question, course)
+
+class ResultsServer(ThreadingMixIn, HTTPServer):
+    # threaded json server, all requests share the api and its cache
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        HTTPServer.__init__(self, address, ResultsHandler)
+        self.api = api
+
+class ResultsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass # keep the console quiet
+
+    def send_json(self, answer, status = 200):
+        content = json.dumps(answer)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        api = self.server.api
+        path, _, query_string = self.path.partition('?')
+        parts = [unquote(part).decode('utf-8') for part in path.strip('/').split('/')]
+        if parts == ['stats']:
+            self.send_json(cache_stats(api))
+        elif len(parts) == 2 and parts[0] == 'course':
+            self.send_json(course_history(api, parts[1]))
+        elif len(parts) == 2 and parts[0] == 'lecturer':
+            self.send_json(lecturer_scores(api, parts[1]))
+        elif len(parts) == 2 and parts[0] == 'question' and parts[1].isdigit():
+            self.send_json(question_trend(api, int(parts[1])))
+        else:
+            self.send_json({'error' : 'unknown path, use /course/<code>, /lecturer/<name>, /question/<id> or /stats'}, 404)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Cached queries on the evaluation database')
+    parser.add_argument('command', choices = ['serve', 'course', 'lecturer', 'question'])
+    parser.add_argument('value', nargs = '?', help = 'course code, lecturer name or question id')
+    parser.add_argument('--db', default = parse_results.DB_URL, help = 'database url (default: %(default)s)')
+    parser.add_argument('--port', type = int, default = PORT, help = 'port of the json server (default: %(default)s)')
+    parser.add_argument('--cache-size', type = int, default = CACHE_SIZE,
+        help = 'max number of cached answers (default: %(default)s)')
+    args = parser.parse_args()
+    api = open_api(args.db, max(args.cache_size, 1))
+
+    if args.command == 'serve':
+        server = ResultsServer(('localhost', args.port), api)
+        print 'Serving %s on http://localhost:%s' % (args.db, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        return
+    if args.value is None:
+        parser.error('%s needs a value' % args.command)
+    if args.command == 'course':
+        answer = course_history(api, args.value)
+    elif args.command == 'lecturer':
+        answer = lecturer_scores(api, args.value)
+    else:
+        answer = question_trend(api, int(args.value))
+    print json.dumps(answer, indent = 1)
+
+if __name__ == '__main__':
+    main()
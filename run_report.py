@@ -0,0 +1,125 @@
+# per-file, per-stage timings and an opt-in profiler for download_results.py, parse_results.py and pipeline.py
+# timings are collected while the report is enabled (--report) and written at the end of the run,
+# as csv (one row per timing) or as json (stage totals and all timings)
+# profiling (--profile TEXT) runs the work for every file or course whose name contains TEXT under cProfile,
+# the stats are written to LOGGING_DIR/profile_<name>.prof, to read with pstats
+import os # os interactions, from std library
+import re # regular expressions, from std library
+import csv # to write csv files, from std library
+import json # to import / export json, from std library
+import time # for timing, from std library
+import logging # logging, from std library
+import threading # lock for timings of concurrent downloads, from std library
+import cProfile # profiler, from std library
+from contextlib import contextmanager # from std library
+
+# globals
+LOGGING_DIR = 'logs'
+CSV_COLUMNS = ['script', 'name', 'stage', 'seconds', 'bytes']
+UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+REPORT = {'enabled' : False, 'profile' : None, 'timings' : [], 'lock' : threading.Lock()}
+
+# functions
+def configure(enabled, profile = None):
+    # enable timings and profiling of names containing profile, parse processes get the same settings
+    # timings collected before are dropped, parse processes would otherwise return those of the main process
+    REPORT['enabled'] = enabled
+    REPORT['profile'] = profile
+    take_timings()
+
+def settings():
+    # settings for configure in parse processes
+    return REPORT['enabled'], REPORT['profile']
+
+def add_timing(script, name, stage, seconds, size = None):
+    if not REPORT['enabled']:
+        return
+    with REPORT['lock']:
+        REPORT['timings'].append({
+            'script' : script,
+            'name' : name,
+            'stage' : stage,
+            'seconds' : round(seconds, 6),
+            'bytes' : size
+            })
+
+@contextmanager
+def timed(script, name, stage):
+    # time the with block as stage of file or course name, the block can set timing['bytes']
+    timing = {'bytes' : None}
+    start_time = time.time()
+    try:
+        yield timing
+    finally:
+        add_timing(script, name, stage, time.time() - start_time, timing['bytes'])
+
+def stage_timer(script, name):
+    # returns lap(stage), which records the time since the previous lap (or since stage_timer) as stage
+    last = [time.time()]
+    def lap(stage, size = None):
+        now = time.time()
+        add_timing(script, name, stage, now - last[0], size)
+        last[0] = now
+    return lap
+
+def take_timings():
+    # remove and return the collected timings, parse processes return them with the parse result
+    with REPORT['lock']:
+        timings = REPORT['timings']
+        REPORT['timings'] = []
+    return timings
+
+def merge_timings(timings):
+    # add timings returned by a parse process
+    with REPORT['lock']:
+        REPORT['timings'].extend(timings)
+
+def stage_totals(timings):
+    # number of timings, seconds and bytes per script and stage
+    totals = {}
+    for timing in timings:
+        total = totals.setdefault((timing['script'], timing['stage']), {
+            'script' : timing['script'],
+            'stage' : timing['stage'],
+            'count' : 0,
+            'seconds' : 0.0,
+            'bytes' : 0
+            })
+        total['count'] += 1
+        total['seconds'] += timing['seconds']
+        total['bytes'] += timing['bytes'] or 0
+    return [totals[key] for key in sorted(totals)]
+
+def write_report(path, script, elapsed):
+    # write collected timings to path, csv for a .csv path, json otherwise
+    timings = take_timings()
+    if path.lower().endswith('.csv'):
+        with open(path, 'wb') as file:
+            writer = csv.DictWriter(file, CSV_COLUMNS)
+            writer.writeheader()
+            for timing in timings:
+                writer.writerow(dict((column, unicode(value).encode('utf-8') if value is not None else '')
+                                     for column, value in timing.items()))
+    else:
+        with open(path, 'w') as file:
+            json.dump({
+                'script' : script,
+                'elapsed' : round(elapsed, 3),
+                'stages' : stage_totals(timings),
+                'timings' : timings
+                }, file, indent = 1)
+    print 'Run report written to', path
+
+def profiled(name, function, *args):
+    # call function(*args), under cProfile if name contains the profile text
+    # only the calling thread is profiled
+    if not REPORT['profile'] or REPORT['profile'] not in name:
+        return function(*args)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        path = os.path.join(LOGGING_DIR, 'profile_' + UNSAFE_CHARACTERS.sub('_', name) + '.prof')
+        profile.dump_stats(path)
+        logging.info('Profile of %s written to %s', name, path)
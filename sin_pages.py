@@ -0,0 +1,148 @@
+# extraction of the channel id and the course evaluation links from SIN-online pages, for download_results.py
+# a small HTMLParser that only follows h2.channel_title and <a> tags, instead of a full BeautifulSoup tree
+# as before, with the same results as BeautifulSoup with lxml: comments and <script> contents are not markup,
+# an anchor that is not closed ends where lxml ends it (at a start tag that lxml lets close it, e.g. the next
+# anchor or a td, or at the end tag of an element around it, e.g. <li><a>text</li>), and like BeautifulSoup's
+# find_all(string = ...) only anchors that hold a single text (optionally inside nested tags, e.g.
+# <a><b>text</b></a>) count as evaluation links
+import re # regular expressions, from std library
+from HTMLParser import HTMLParser, HTMLParseError # from std library
+
+# globals
+CHANNEL_ID = re.compile('#([0-9]+)')
+EVALUATION_TITLE = re.compile('course evaluation|onderwijsevaluatie', re.IGNORECASE)
+EVALUATION_ID = re.compile('objid=([0-9]+)')
+VOID_TAGS = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'wbr')
+# start tags that close the innermost open element, as lxml (libxml2) does, for the elements of list pages
+AUTO_CLOSE = {
+    'a' : ('a', 'td', 'th', 'table'),
+    'p' : ('p', 'li', 'td', 'th', 'tr', 'dt', 'dd', 'div', 'ul', 'ol', 'table', 'h2', 'form', 'pre'),
+    'li' : ('li',),
+    'td' : ('td', 'th', 'tr'),
+    'th' : ('td', 'th', 'tr'),
+    'tr' : ('tr',),
+    'dt' : ('dd',),
+    'dd' : ('dt',),
+    'option' : ('option',),
+    'b' : ('p', 'td', 'th'),
+    'span' : ('td', 'th'),
+    'ul' : ('ol', 'form', 'pre'),
+    'ol' : ('ul', 'form'),
+    'h2' : ('p', 'li', 'table', 'form'),
+    'form' : ('form',),
+    'pre' : ('li', 'dt', 'dd', 'ul', 'table', 'form')
+    }
+# an end tag does not close elements with a higher priority, as in libxml2, other elements have priority 100
+END_PRIORITY = {'div' : 150, 'td' : 160, 'th' : 160, 'tr' : 170, 'thead' : 180, 'tbody' : 180, 'tfoot' : 180,
+                'table' : 190, 'head' : 200, 'body' : 200, 'html' : 220}
+
+# functions
+class SINPageParser(HTMLParser):
+    # collects the first h2 with class channel_title and all anchors, as lists of attribute values and texts
+    # open_tags holds the names of the open elements, only to know where anchors end, no tree is built
+    # open_anchors are the anchors still open, anchor['level'] is the index of the anchor in open_tags
+    # anchor['single_text'] is False when the anchor holds more than its single text, as other tags or a comment
+    # anchor phases: 'open' (nested start tags), 'text' (in the text), 'close' (nested end tags after the text)
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.channel_title = None
+        self.in_channel_title = False
+        self.anchors = []
+        self.open_anchors = []
+        self.open_tags = []
+
+    def close_elements(self, index):
+        # close the open elements from index on and the anchors among them, for the anchors around them
+        # the closed elements are nested tags, which either end before the text or follow it
+        del self.open_tags[index:]
+        self.open_anchors = [anchor for anchor in self.open_anchors if anchor['level'] < index]
+        for anchor in self.open_anchors:
+            if anchor['phase'] == 'open': # tag without text
+                anchor['single_text'] = False
+            else:
+                anchor['phase'] = 'close'
+
+    def handle_starttag(self, tag, attrs):
+        values = [value for name, value in attrs if value]
+        while self.open_tags and tag in AUTO_CLOSE.get(self.open_tags[-1], ()):
+            self.close_elements(len(self.open_tags) - 1)
+        for anchor in self.open_anchors:
+            anchor['parts'].extend(values)
+            if anchor['phase'] != 'open' or tag in VOID_TAGS:
+                anchor['single_text'] = False
+        if tag in VOID_TAGS:
+            return
+        self.open_tags.append(tag)
+        if tag == 'a':
+            anchor = {'parts' : values, 'text' : [], 'phase' : 'open', 'single_text' : True,
+                      'level' : len(self.open_tags) - 1}
+            self.anchors.append(anchor)
+            self.open_anchors.append(anchor)
+        if self.in_channel_title:
+            self.channel_title.extend(values)
+        elif tag == 'h2' and self.channel_title is None and 'channel_title' in (dict(attrs).get('class') or '').split():
+            self.channel_title = values
+            self.in_channel_title = True
+
+    def handle_endtag(self, tag):
+        if tag == 'h2':
+            self.in_channel_title = False
+        if tag not in self.open_tags: # end tag without start tag, ignored as by lxml
+            return
+        index = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        priority = END_PRIORITY.get(tag, 100)
+        if any(END_PRIORITY.get(open_tag, 100) > priority for open_tag in self.open_tags[index + 1:]):
+            return
+        self.close_elements(index)
+
+    def handle_data(self, data):
+        if self.in_channel_title:
+            self.channel_title.append(data)
+        for anchor in self.open_anchors:
+            anchor['parts'].append(data)
+            anchor['text'].append(data)
+            if anchor['phase'] == 'close':
+                anchor['single_text'] = False
+            anchor['phase'] = 'text'
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+    def handle_comment(self, data):
+        for anchor in self.open_anchors:
+            anchor['single_text'] = False
+
+def parse_page(page):
+    # parsed page, a page that HTMLParser gives up on keeps what was found up to that point
+    parser = SINPageParser()
+    try:
+        parser.feed(page)
+        parser.close()
+    except HTMLParseError:
+        pass
+    return parser
+
+def extract_channel_id(channel_page):
+    # find channel id in the channel_title heading of the channel page, None if not found
+    parser = parse_page(channel_page)
+    if parser.channel_title is None:
+        return None
+    channel_id = CHANNEL_ID.search(u' '.join(parser.channel_title))
+    if not channel_id:
+        return None
+    return channel_id.group(1)
+
+def extract_evaluation_ids(evaluation_page):
+    # find {evaluation id: title} for the course evaluation links on the questionnaire page
+    evaluation_id_collection = {}
+    for anchor in parse_page(evaluation_page).anchors:
+        text = u''.join(anchor['text'])
+        if not anchor['single_text'] or not anchor['text'] or not EVALUATION_TITLE.search(text):
+            continue
+        evaluation_id = EVALUATION_ID.search(u' '.join(anchor['parts']))
+        if evaluation_id:
+            evaluation_id_collection[evaluation_id.group(1)] = text.lower()
+    return evaluation_id_collection
@@ -0,0 +1,154 @@
+# local stand-in for the SIN-online pages used by download_results.py
+# serves the files in a fixture dir, layout:
+#   courses.txt              json: {"VAKACODE-YEAR": {"channel_id": "123", "evaluations": {"456": "Onderwijsevaluatie blok 1"}}}
+#   definitions/<objid>.txt  served as dump.html-nf
+#   spss/<objid>.txt         served as report_spss.html-nf
+#   excel/<objid>.xls        served as report_xls.html
+# usage: python sin_stub_server.py FIXTURE_DIR [--port 8000] [--latency 0.05]
+# then: python download_results.py inputfile --base-url http://localhost:8000
+# fixtures.py generates fixture dirs of any size
+import os # os interactions, from std library
+import json # to import / export json, from std library
+import random # for simulated server errors, from std library
+import time # for simulated latency, from std library
+import threading # lock for request counter, from std library
+import argparse # command line arguments, from std library
+import uuid # session ids, from std library
+from urlparse import urlparse, parse_qs # from std library
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # from std library
+from SocketServer import ThreadingMixIn # from std library
+
+# globals
+PORT = 8000
+SESSION_COOKIE = 'sin_session'
+
+class SINStubServer(ThreadingMixIn, HTTPServer):
+    # threaded http server, holds the fixtures and the simulated failure settings
+    daemon_threads = True
+
+    def __init__(self, address, fixture_dir, fail_rate = 0.0, drop_login_every = 0, latency = 0.0):
+        HTTPServer.__init__(self, address, SINStubHandler)
+        self.fixture_dir = fixture_dir
+        with open(os.path.join(fixture_dir, 'courses.txt')) as file:
+            self.courses = json.load(file)
+        self.fail_rate = fail_rate
+        self.drop_login_every = drop_login_every
+        self.latency = latency
+        self.sessions = set()
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+class SINStubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass # keep the console quiet
+
+    def send_content(self, content, content_type = 'text/html; charset=utf-8', headers = None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path, content_type):
+        if not os.path.exists(path):
+            self.send_content('') # SIN-online answers with an empty page for unknown ids
+            return
+        with open(path, 'rb') as file:
+            self.send_content(file.read(), content_type)
+
+    def logged_in(self):
+        # check session cookie, drop all logins every drop_login_every requests
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            if server.drop_login_every and server.request_count % server.drop_login_every == 0:
+                server.sessions.clear()
+            cookies = self.headers.get('Cookie', '')
+            return any(cookie.strip() == SESSION_COOKIE + '=' + session
+                       for cookie in cookies.split(';') for session in server.sessions)
+
+    def delay(self):
+        # simulated network and server latency, before every response
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_POST(self):
+        self.delay()
+        if urlparse(self.path).path != '/channel/index.html':
+            self.send_error(404)
+            return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        session = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.sessions.add(session)
+        self.send_content('<html><body>logged in</body></html>',
+            headers = {'Set-Cookie' : SESSION_COOKIE + '=' + session + '; Path=/'})
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        self.delay()
+        if random.random() < server.fail_rate:
+            self.send_error(503)
+            return
+        if url.path == '/channel/index.html':
+            self.send_content('<html><body><form><input name="login_passwd"></form></body></html>')
+            return
+        if not self.logged_in():
+            self.send_response(302)
+            self.send_header('Location', '/channel/index.html')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if url.path == '/channel/pub/channel.html':
+            course = server.courses.get(query.get('mod'))
+            if course is None:
+                self.send_content('')
+                return
+            self.send_content((u'<html><body><h2 class="channel_title">%s #%s</h2></body></html>'
+                % (query['mod'], course['channel_id'])).encode('utf-8'))
+        elif url.path == '/channel/quest/object.html':
+            anchors = []
+            for course in server.courses.values():
+                if course['channel_id'] == query.get('chid'):
+                    for evaluation_id, title in sorted(course['evaluations'].items()):
+                        anchors.append('<li><a href="/channel/quest/object.html?objid=%s">%s</a></li>'
+                            % (evaluation_id, title))
+            self.send_content(('<html><body><ul>%s</ul></body></html>' % ''.join(anchors)).encode('utf-8'))
+        elif url.path == '/channel/quest/dump.html-nf':
+            self.send_file(os.path.join(server.fixture_dir, 'definitions', query.get('objid', '') + '.txt'),
+                'text/plain; charset=utf-8')
+        elif url.path == '/channel/quest/report_spss.html-nf':
+            self.send_file(os.path.join(server.fixture_dir, 'spss', query.get('objid', '') + '.txt'),
+                'text/plain; charset=utf-8')
+        elif url.path == '/channel/quest/report_xls.html':
+            self.send_file(os.path.join(server.fixture_dir, 'excel', query.get('objid', '') + '.xls'),
+                'application/vnd.ms-excel')
+        else:
+            self.send_error(404)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the SIN-online pages used by download_results.py')
+    parser.add_argument('fixture_dir', help = 'dir with courses.txt and definitions, spss and excel dirs')
+    parser.add_argument('--port', type = int, default = PORT, help = 'default: %(default)s')
+    parser.add_argument('--fail-rate', type = float, default = 0.0,
+        help = 'fraction of requests answered with 503, to test retries')
+    parser.add_argument('--drop-login-every', type = int, default = 0,
+        help = 'drop all logins every n requests, to test re-authentication')
+    parser.add_argument('--latency', type = float, default = 0.0,
+        help = 'seconds to wait before every response (default: %(default)s)')
+    args = parser.parse_args()
+    server = SINStubServer(('localhost', args.port), args.fixture_dir, args.fail_rate, args.drop_login_every,
+        args.latency)
+    print 'Serving', args.fixture_dir, 'on http://localhost:%s' % args.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()